@@ -0,0 +1,570 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import random
+import time
+import typing
+import uuid
+from typing import Any, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.methods import (
+    DeleteMessage,
+    EditMessageMedia,
+    SendPhoto,
+    TelegramMethod
+)
+from aiogram.methods.base import TelegramType
+from aiogram.types import (
+    CallbackQuery,
+    Chat,
+    InlineKeyboardMarkup,
+    Message,
+    PhotoSize,
+    Update,
+    User
+)
+from aiohttp import web
+from environs import Env
+from redis.asyncio import Redis
+
+from bot import register_handlers
+from carts import CachedCartStore, LockedCartStore, RedisCartStore, StrapiCartStore
+from catalog import CatalogRefresher, CatalogStore
+from checkout import CheckoutOutbox, checkout_counter
+from customers import CustomerResolver
+from fsm_storage import CompactRedisStorage
+from handlers import MenuKeyboardCache
+from instrumentation import handler_name
+from locks import UserLocks
+from photo_cache import PhotoCache
+from product_images import ImageByteCache, ProductImages, ProductViews
+from send_scheduler import SendScheduler
+from strapi_helpers import StrapiClient
+
+logger = logging.getLogger(__file__)
+
+BENCHMARK_TELEGRAM_ID_BASE = 10 ** 12
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: list[float], rank: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(rank / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def make_document_id() -> str:
+    return uuid.uuid4().hex[:24]
+
+
+class FakeStrapi:
+    """Strapi в памяти с теми же маршрутами и формой ответов, что ждёт StrapiClient.
+
+    Каждый запрос задерживается на latency ± jitter секунд, доля
+    failure_rate запросов завершается ответом 503.
+    """
+
+    def __init__(
+            self,
+            products: int,
+            image_size: int,
+            latency: float,
+            jitter: float,
+            failure_rate: float
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.image = random.randbytes(image_size)
+        self.requests = 0
+        self.failures = 0
+        self.ids = itertools.count(1)
+        self.carts: dict[str, dict] = {}
+        self.cart_items: dict[str, dict] = {}
+        self.customers: dict[str, dict] = {}
+
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.products = []
+        for number in range(products):
+            document_id = make_document_id()
+            self.products.append({
+                "id": next(self.ids),
+                "documentId": document_id,
+                "title": f"Рыба {number}",
+                "price": 100 + number,
+                "description": f"Описание товара {number}",
+                "image": {
+                    "url": f"/uploads/{document_id}.jpg",
+                    "hash": document_id,
+                    "updatedAt": now
+                },
+                "updatedAt": now
+            })
+        self.products_by_id = {product['documentId']: product for product in self.products}
+
+    @web.middleware
+    async def chaos(self, request: web.Request, handler):
+        self.requests += 1
+        delay = random.gauss(self.latency, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return web.json_response({"error": "unavailable"}, status=503)
+        return await handler(request)
+
+    def build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.chaos])
+        app.router.add_get('/api/products', self.list_products)
+        app.router.add_get('/api/carts', self.list_carts)
+        app.router.add_post('/api/carts', self.create_cart)
+        app.router.add_put('/api/carts/{document_id}', self.update_cart)
+        app.router.add_post('/api/cart-items', self.create_cart_item)
+        app.router.add_put('/api/cart-items/{document_id}', self.update_cart_item)
+        app.router.add_delete('/api/cart-items/{document_id}', self.delete_cart_item)
+        app.router.add_get('/api/customers', self.list_customers)
+        app.router.add_post('/api/customers', self.create_customer)
+        app.router.add_put('/api/customers/{document_id}', self.update_customer)
+        app.router.add_delete('/api/customers/{document_id}', self.delete_customer)
+        app.router.add_get('/uploads/{name}', self.download_image)
+        return app
+
+    @staticmethod
+    def _paginate(request: web.Request, records: list) -> web.Response:
+        page = int(request.query.get('pagination[page]', 1))
+        page_size = int(request.query.get('pagination[pageSize]', 25))
+        page_count = max(1, -(-len(records) // page_size))
+        start = (page - 1) * page_size
+        return web.json_response({
+            "data": records[start:start + page_size],
+            "meta": {"pagination": {
+                "page": page,
+                "pageSize": page_size,
+                "pageCount": page_count,
+                "total": len(records)
+            }}
+        })
+
+    @staticmethod
+    async def _data(request: web.Request) -> dict:
+        return (await request.json()).get('data') or {}
+
+    async def list_products(self, request: web.Request) -> web.Response:
+        updated_after = request.query.get('filters[updatedAt][$gt]')
+        products = [
+            product for product in self.products
+            if not updated_after or product['updatedAt'] > updated_after
+        ]
+        return self._paginate(request, products)
+
+    def _render_cart(self, cart: dict) -> dict:
+        items = [
+            {**item, "product": self.products_by_id.get(item['product'])}
+            for item in self.cart_items.values()
+            if item['cart'] == cart['documentId']
+        ]
+        return {**cart, "items": items}
+
+    async def list_carts(self, request: web.Request) -> web.Response:
+        telegram_id = request.query.get('filters[telegram_id][$eq]')
+        order_status = request.query.get('filters[order_status][$eq]')
+        carts = [
+            self._render_cart(cart) for cart in self.carts.values()
+            if (telegram_id is None or cart['telegram_id'] == telegram_id)
+            and (order_status is None or cart['order_status'] == order_status)
+        ]
+        return self._paginate(request, carts)
+
+    async def create_cart(self, request: web.Request) -> web.Response:
+        data = await self._data(request)
+        cart = {
+            "id": next(self.ids),
+            "documentId": make_document_id(),
+            "telegram_id": str(data.get('telegram_id')),
+            "order_status": data.get('order_status', 'active'),
+            "customer": None
+        }
+        self.carts[cart['documentId']] = cart
+        return web.json_response({"data": self._render_cart(cart)})
+
+    async def update_cart(self, request: web.Request) -> web.Response:
+        cart = self.carts.get(request.match_info['document_id'])
+        if cart is None:
+            return web.json_response({"error": "not found"}, status=404)
+        cart.update(await self._data(request))
+        return web.json_response({"data": self._render_cart(cart)})
+
+    async def create_cart_item(self, request: web.Request) -> web.Response:
+        data = await self._data(request)
+        if data.get('cart') not in self.carts:
+            return web.json_response({"error": "cart not found"}, status=400)
+        item = {
+            "id": next(self.ids),
+            "documentId": make_document_id(),
+            "quantity": data.get('quantity', 1),
+            "cart": data['cart'],
+            "product": data.get('product')
+        }
+        self.cart_items[item['documentId']] = item
+        return web.json_response({"data": item})
+
+    async def update_cart_item(self, request: web.Request) -> web.Response:
+        item = self.cart_items.get(request.match_info['document_id'])
+        if item is None:
+            return web.json_response({"error": "not found"}, status=404)
+        item.update(await self._data(request))
+        return web.json_response({"data": item})
+
+    async def delete_cart_item(self, request: web.Request) -> web.Response:
+        if self.cart_items.pop(request.match_info['document_id'], None) is None:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.Response(status=204)
+
+    async def list_customers(self, request: web.Request) -> web.Response:
+        telegram_id = request.query.get('filters[telegram_id][$eq]')
+        customers = [
+            customer for customer in self.customers.values()
+            if telegram_id is None or customer['telegram_id'] == telegram_id
+        ]
+        return self._paginate(request, customers)
+
+    async def create_customer(self, request: web.Request) -> web.Response:
+        data = await self._data(request)
+        customer = {
+            "id": next(self.ids),
+            "documentId": make_document_id(),
+            "telegram_id": str(data.get('telegram_id')),
+            "email": data.get('email'),
+            "username": data.get('username')
+        }
+        self.customers[customer['documentId']] = customer
+        return web.json_response({"data": customer})
+
+    async def update_customer(self, request: web.Request) -> web.Response:
+        customer = self.customers.get(request.match_info['document_id'])
+        if customer is None:
+            return web.json_response({"error": "not found"}, status=404)
+        customer.update(await self._data(request))
+        return web.json_response({"data": customer})
+
+    async def delete_customer(self, request: web.Request) -> web.Response:
+        if self.customers.pop(request.match_info['document_id'], None) is None:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.Response(status=204)
+
+    async def download_image(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.image, content_type="image/jpeg")
+
+
+class FakeTelegramSession(BaseSession):
+    """Сессия бота без сети: отвечает на методы Bot API правдоподобными объектами.
+
+    Запоминает последнее сообщение бота в каждом чате, чтобы синтетический
+    пользователь нажимал кнопки под тем сообщением, которое ему показали.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+        self.message_ids = itertools.count(1)
+        self.last_messages: dict[int, Message] = {}
+
+    def _message(self, bot: Bot, method: TelegramMethod, with_photo: bool) -> Message:
+        chat_id = method.chat_id
+        message_id = getattr(method, 'message_id', None) or next(self.message_ids)
+        photo = None
+        if with_photo:
+            file_id = f"photo-{uuid.uuid4().hex}"
+            photo = [PhotoSize(file_id=file_id, file_unique_id=file_id, width=800, height=600)]
+
+        message = Message(
+            message_id=message_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            from_user=User(id=bot.id, is_bot=True, first_name="Shop"),
+            text=None if with_photo else getattr(method, 'text', None),
+            caption=getattr(method, 'caption', None),
+            photo=photo,
+            reply_markup=getattr(method, 'reply_markup', None)
+        ).as_(bot)
+        self.last_messages[chat_id] = message
+        return message
+
+    async def make_request(
+            self,
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+            timeout: Optional[int] = None
+    ) -> TelegramType:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if isinstance(method, DeleteMessage):
+            return True
+
+        returning = method.__returning__
+        if returning is Message or Message in typing.get_args(returning):
+            with_photo = isinstance(method, (SendPhoto, EditMessageMedia))
+            return self._message(bot, method, with_photo)
+        if returning is bool:
+            return True
+        raise NotImplementedError(f"Фейковая сессия не умеет {type(method).__name__}")
+
+    async def stream_content(self, url: str, headers=None, timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class LatencyRecorder(BaseMiddleware):
+    """Сохраняет каждое измерение обработчика, чтобы считать точные перцентили."""
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+
+    async def __call__(self, handler, event, data: dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = handler_name(data['handler'])
+            self.samples.setdefault(name, []).append(time.perf_counter() - started)
+
+
+class SyntheticUser:
+    """Проходит сценарий покупки, нажимая кнопки из присланных ботом сообщений."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, session: FakeTelegramSession, telegram_id: int,
+                 update_ids: itertools.count, update_latencies: list[float]):
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.user = User(id=telegram_id, is_bot=False, first_name="Bench", username=f"bench{telegram_id}")
+        self.chat = Chat(id=telegram_id, type="private")
+        self.update_ids = update_ids
+        self.update_latencies = update_latencies
+
+    async def _feed(self, **event):
+        update = Update(update_id=next(self.update_ids), **event)
+        started = time.perf_counter()
+        await self.dp.feed_update(self.bot, update)
+        self.update_latencies.append(time.perf_counter() - started)
+
+    async def send_text(self, text: str):
+        await self._feed(message=Message(
+            message_id=next(self.session.message_ids),
+            date=datetime.datetime.now(),
+            chat=self.chat,
+            from_user=self.user,
+            text=text
+        ))
+
+    async def press(self, data: str):
+        await self._feed(callback_query=CallbackQuery(
+            id=uuid.uuid4().hex,
+            from_user=self.user,
+            chat_instance=str(self.chat.id),
+            message=self.session.last_messages.get(self.chat.id),
+            data=data
+        ))
+
+    def buttons(self, prefix: str) -> list[str]:
+        message = self.session.last_messages.get(self.chat.id)
+        markup: Optional[InlineKeyboardMarkup] = message.reply_markup if message else None
+        if markup is None:
+            return []
+        return [
+            button.callback_data
+            for row in markup.inline_keyboard
+            for button in row
+            if button.callback_data and button.callback_data.startswith(prefix)
+        ]
+
+    async def shop(self):
+        await self.send_text("/start")
+        products = self.buttons("product_")
+        for product in random.sample(products, min(2, len(products))):
+            await self.press(product)
+            await self.press("add_to_cart")
+            await self.press("back_to_menu")
+
+        await self.press("show_cart")
+        removable = self.buttons("remove_item_")
+        if removable:
+            await self.press(removable[0])
+        await self.press("pay")
+        await self.send_text(f"{self.user.username}@example.com")
+
+
+def report(args: argparse.Namespace, recorder: LatencyRecorder, update_latencies: list[float], elapsed: float,
+           strapi: FakeStrapi, session: FakeTelegramSession) -> dict:
+    result = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "updates": len(update_latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_second": round(len(update_latencies) / elapsed, 1) if elapsed else 0.0,
+        "strapi_requests": strapi.requests,
+        "strapi_failures": strapi.failures,
+        "telegram_requests": session.requests,
+        "checkouts_completed": checkout_counter.value(result="completed"),
+        "latency_ms": {}
+    }
+    for name, samples in sorted(recorder.samples.items()) + [("update", update_latencies)]:
+        result["latency_ms"][name] = {
+            "count": len(samples),
+            **{f"p{rank}": round(percentile(samples, rank) * 1000, 2) for rank in PERCENTILES}
+        }
+
+    print(f"Апдейтов: {result['updates']} за {result['elapsed_seconds']} с "
+          f"({result['updates_per_second']} в секунду)")
+    print(f"Запросов к Strapi: {strapi.requests} (ошибок: {strapi.failures}), "
+          f"к Bot API: {session.requests}, оформлено заказов: {result['checkouts_completed']:.0f}")
+    print(f"{'обработчик':<24}{'n':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, stats in result["latency_ms"].items():
+        print(f"{name:<24}{stats['count']:>7}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}")
+    return result
+
+
+async def run(args: argparse.Namespace, redis_conn: Redis):
+    fake_strapi = FakeStrapi(
+        products=args.products,
+        image_size=args.image_size,
+        latency=args.strapi_latency,
+        jitter=args.strapi_jitter,
+        failure_rate=args.strapi_failure_rate
+    )
+    strapi_runner = web.AppRunner(fake_strapi.build_app(), access_log=None)
+    await strapi_runner.setup()
+    site = web.TCPSite(strapi_runner, "127.0.0.1", 0)
+    await site.start()
+    strapi_base_url = f"http://127.0.0.1:{strapi_runner.addresses[0][1]}"
+
+    strapi = StrapiClient(strapi_base_url, "benchmark")
+    catalog = CatalogStore()
+    catalog_refresher = CatalogRefresher(strapi, f"{strapi_base_url}/api/products", catalog)
+    session = FakeTelegramSession(latency=args.telegram_latency)
+    bot = Bot(token="42:benchmark", session=session)
+    if args.rate_limit:
+        bot.session.middleware(SendScheduler())
+
+    if args.fsm_storage == 'compact':
+        storage = CompactRedisStorage(redis_conn)
+    else:
+        storage = RedisStorage(redis=redis_conn)
+    dp = Dispatcher(storage=storage)
+    recorder = LatencyRecorder()
+    dp.message.middleware(recorder)
+    dp.callback_query.middleware(recorder)
+
+    user_locks = UserLocks(redis_conn)
+    if args.cart_mode == 'redis':
+        cart_store = RedisCartStore(redis_conn, strapi, catalog, user_locks=user_locks)
+    else:
+        cart_store = StrapiCartStore(strapi)
+    if args.cart_cache_ttl > 0:
+        cart_store = CachedCartStore(cart_store, redis_conn, ttl=args.cart_cache_ttl)
+    cart_store = LockedCartStore(cart_store, user_locks)
+    customers = CustomerResolver(redis_conn, strapi)
+    outbox = CheckoutOutbox(redis_conn, bot, strapi, cart_store, customers, user_locks, retry_delay=1)
+
+    photo_cache = PhotoCache(redis_conn)
+    images = ProductImages(
+        strapi,
+        memory_cache=ImageByteCache(args.image_memory_cache_mb * 1024 * 1024) if args.image_memory_cache_mb else None,
+        views=ProductViews(redis_conn),
+        photo_cache=photo_cache
+    )
+    register_handlers(dp, catalog, bot, images, photo_cache, cart_store, outbox, MenuKeyboardCache())
+
+    try:
+        if not await catalog_refresher.refresh(full=True):
+            raise RuntimeError("Не удалось загрузить каталог из фейкового Strapi")
+        cart_store.start()
+        outbox.start()
+
+        update_ids = itertools.count(1)
+        update_latencies: list[float] = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+        telegram_id_base = BENCHMARK_TELEGRAM_ID_BASE + random.randrange(10 ** 9)
+
+        async def shop(number: int):
+            async with semaphore:
+                user = SyntheticUser(dp, bot, session, telegram_id_base + number, update_ids, update_latencies)
+                await user.shop()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(shop(number) for number in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        deadline = time.monotonic() + args.drain_timeout
+        while checkout_counter.value(result="completed") < args.users and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        result = report(args, recorder, update_latencies, elapsed, fake_strapi, session)
+        if args.json:
+            with open(args.json, 'w') as report_file:
+                json.dump(result, report_file, ensure_ascii=False, indent=2)
+    finally:
+        await outbox.stop()
+        await cart_store.stop()
+        await strapi.close()
+        await strapi_runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Нагрузочный прогон бота на фейковых Strapi и Telegram"
+    )
+    parser.add_argument('--users', type=int, default=200, help="сколько покупателей пройдут сценарий")
+    parser.add_argument('--concurrency', type=int, default=50, help="сколько покупателей действуют одновременно")
+    parser.add_argument('--products', type=int, default=50)
+    parser.add_argument('--image-size', type=int, default=100_000, help="размер картинки товара в байтах")
+    parser.add_argument('--strapi-latency', type=float, default=0.02, help="задержка ответа Strapi в секундах")
+    parser.add_argument('--strapi-jitter', type=float, default=0.005)
+    parser.add_argument('--strapi-failure-rate', type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="задержка ответа Bot API в секундах")
+    parser.add_argument('--rate-limit', action='store_true', help="пропускать отправку через SendScheduler")
+    parser.add_argument('--cart-mode', choices=('strapi', 'redis'), default='strapi')
+    parser.add_argument('--cart-cache-ttl', type=int, default=30)
+    parser.add_argument('--fsm-storage', choices=('compact', 'redis'), default='compact')
+    parser.add_argument('--image-memory-cache-mb', type=int, default=64, help="0 отключает кэш картинок и предзагрузку")
+    parser.add_argument('--drain-timeout', type=float, default=10, help="сколько ждать оформления заказов")
+    parser.add_argument('--redis-db', type=int, default=15, help="отдельная база Redis под прогон")
+    parser.add_argument('--json', help="сохранить результат в файл для сравнения прогонов")
+    args = parser.parse_args()
+
+    env = Env()
+    env.read_env()
+
+    redis_conn = Redis(
+        host=env.str("DATABASE_HOST", "localhost"),
+        port=env.int("DATABASE_PORT", 6379),
+        password=env.str("DATABASE_PASSWORD", None),
+        db=args.redis_db,
+        decode_responses=False
+    )
+    try:
+        await run(args, redis_conn)
+    finally:
+        await redis_conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    asyncio.run(main())
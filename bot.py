@@ -8,59 +8,123 @@ from aiogram.fsm.storage.redis import RedisStorage
 from environs import Env
 from redis.asyncio import Redis
 
+from carts import (
+    CART_FLUSH_INTERVAL,
+    CART_SNAPSHOT_TTL,
+    CachedCartStore,
+    CartStore,
+    LockedCartStore,
+    RedisCartStore,
+    StrapiCartStore
+)
+from catalog import CATALOG_REFRESH_INTERVAL, CatalogRefresher, CatalogStore
+from catalog_snapshot import CATALOG_SNAPSHOT_PATH, FileCatalogSnapshot, RedisCatalogSnapshot
+from checkout import CHECKOUT_MAX_ATTEMPTS, CHECKOUT_RETRY_DELAY, CheckoutOutbox
+from customers import CustomerResolver
+from fsm_storage import FSM_DATA_TTL, FSM_STATE_TTL, CompactRedisStorage
 from handlers import (
     cmd_start,
     main_menu_handler,
     BotStates,
     back_to_menu_handler,
+    menu_page_handler,
     add_to_cart_handler,
     show_cart_handler,
     remove_item_handler,
     pay_handler,
-    email_handler
+    email_handler,
+    MenuKeyboardCache
+)
+from instrumentation import (
+    METRICS_HOST,
+    METRICS_PORT,
+    setup_instrumentation,
+    start_metrics_server
 )
-from strapi_helpers import get_products
+from locks import UserLocks
+from photo_cache import PhotoCache
+from product_images import (
+    IMAGE_MEMORY_CACHE_BYTES,
+    PHOTO_QUALITY,
+    PHOTO_SIZE,
+    PREFETCH_LIMIT,
+    ImageByteCache,
+    ProductImages,
+    ProductViews,
+    TranscodedImageCache
+)
+from send_scheduler import CHAT_RATE, GLOBAL_RATE, SendScheduler
+from strapi_helpers import StrapiClient
+from telegram_session import PreparedMarkupSession
+from tracing import PROFILE_DIR, SLOW_UPDATE_THRESHOLD, Profiler
+from webhook import DRAIN_TIMEOUT, SHUTDOWN_GRACE, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, run_webhook
 
 logger = logging.getLogger(__file__)
 
 
 def register_handlers(
         dp: Dispatcher,
-        products: list,
+        catalog: CatalogStore,
         bot: Bot,
-        strapi_base_url: str,
-        strapi_token: str
+        images: ProductImages,
+        photo_cache: PhotoCache,
+        cart_store: CartStore,
+        outbox: CheckoutOutbox,
+        menu_keyboards: MenuKeyboardCache
 ):
     dp.message.register(
-        partial(cmd_start, products=products),
+        partial(cmd_start, catalog=catalog, images=images, menu_keyboards=menu_keyboards),
         Command("start")
     )
     dp.callback_query.register(
-        partial(main_menu_handler, products=products, bot=bot, strapi_base_url=strapi_base_url),
+        partial(
+            main_menu_handler,
+            catalog=catalog,
+            bot=bot,
+            images=images,
+            photo_cache=photo_cache
+        ),
         F.data.startswith('product_'),
         BotStates.HANDLE_MENU
     )
     dp.callback_query.register(
-        partial(back_to_menu_handler, products=products, bot=bot),
+        partial(menu_page_handler, catalog=catalog, images=images, menu_keyboards=menu_keyboards),
+        F.data.startswith('menu_page_'),
+        BotStates.HANDLE_MENU
+    )
+    dp.callback_query.register(
+        partial(
+            back_to_menu_handler,
+            catalog=catalog,
+            bot=bot,
+            images=images,
+            menu_keyboards=menu_keyboards
+        ),
         F.data == 'back_to_menu',
         BotStates.HANDLE_DESCRIPTION
     )
     dp.callback_query.register(
-        partial(back_to_menu_handler, products=products, bot=bot),
+        partial(
+            back_to_menu_handler,
+            catalog=catalog,
+            bot=bot,
+            images=images,
+            menu_keyboards=menu_keyboards
+        ),
         F.data == 'back_to_menu',
         BotStates.HANDLE_CART
     )
     dp.callback_query.register(
-        partial(add_to_cart_handler, strapi_base_url=strapi_base_url, strapi_token=strapi_token),
+        partial(add_to_cart_handler, cart_store=cart_store),
         F.data == 'add_to_cart',
         BotStates.HANDLE_DESCRIPTION
     )
     dp.callback_query.register(
-        partial(show_cart_handler, strapi_base_url=strapi_base_url, strapi_token=strapi_token, bot=bot),
+        partial(show_cart_handler, cart_store=cart_store, bot=bot),
         F.data == 'show_cart'
     )
     dp.callback_query.register(
-        partial(remove_item_handler, strapi_base_url=strapi_base_url, strapi_token=strapi_token, bot=bot),
+        partial(remove_item_handler, cart_store=cart_store, bot=bot),
         F.data.startswith('remove_item_'),
         BotStates.HANDLE_CART
     )
@@ -70,7 +134,7 @@ def register_handlers(
         BotStates.HANDLE_CART
     )
     dp.message.register(
-        partial(email_handler, strapi_base_url=strapi_base_url, strapi_token=strapi_token),
+        partial(email_handler, outbox=outbox),
         BotStates.WAITING_EMAIL
     )
 
@@ -86,16 +150,17 @@ async def main():
     strapi_url = env.str('STRAPI_URL')
     strapi_token = env.str('STRAPI_TOKEN')
     strapi_base_url = env.str('STRAPI_BASE_URL')
+    catalog_refresh_interval = env.float('CATALOG_REFRESH_INTERVAL', CATALOG_REFRESH_INTERVAL)
+    cart_mode = env.str('CART_MODE', 'strapi')
+    cart_flush_interval = env.float('CART_FLUSH_INTERVAL', CART_FLUSH_INTERVAL)
+    cart_cache_ttl = env.int('CART_CACHE_TTL', CART_SNAPSHOT_TTL)
+    bot_mode = env.str('BOT_MODE', 'polling')
 
-    logger.info("Загрузка продуктов...")
-    raw_products = get_products(strapi_url, strapi_token)
-
-    if raw_products and 'data' in raw_products:
-        products = raw_products['data']
-        logger.info(f"Загружено товаров: {len(products)}")
-    else:
-        logger.error("Не удалось загрузить товары, бот не будет запущен.")
-        return
+    strapi = StrapiClient(
+        strapi_base_url,
+        strapi_token,
+        timeouts=env.dict('STRAPI_TIMEOUTS', {}, subcast_values=float)
+    )
 
     redis_conn = Redis(
         host=redis_host,
@@ -104,16 +169,146 @@ async def main():
         decode_responses=False
     )
 
-    bot = Bot(token=tg_token)
-    storage = RedisStorage(redis=redis_conn)
+    catalog_snapshot_mode = env.str('CATALOG_SNAPSHOT', 'redis')
+    if catalog_snapshot_mode == 'file':
+        catalog_snapshot = FileCatalogSnapshot(env.str('CATALOG_SNAPSHOT_PATH', CATALOG_SNAPSHOT_PATH))
+    elif catalog_snapshot_mode == 'redis':
+        catalog_snapshot = RedisCatalogSnapshot(redis_conn)
+    else:
+        catalog_snapshot = None
+
+    logger.info("Загрузка продуктов...")
+    catalog = CatalogStore()
+    catalog_refresher = CatalogRefresher(
+        strapi,
+        strapi_url,
+        catalog,
+        interval=catalog_refresh_interval,
+        snapshot=catalog_snapshot
+    )
+
+    # Со снимком бот стартует сразу, а сверка со Strapi идёт в фоне
+    warm_started = await catalog_refresher.warm_start()
+    if not warm_started:
+        if await catalog_refresher.refresh(full=True):
+            logger.info(f"Загружено товаров: {len(catalog.current.products)}")
+        else:
+            logger.error("Не удалось загрузить товары, бот не будет запущен.")
+            await strapi.close()
+            await redis_conn.close()
+            return
+
+    bot = Bot(token=tg_token, session=PreparedMarkupSession())
+    # Очередь отправки своя у каждого процесса: общий лимит бота делится между воркерами
+    bot.session.middleware(SendScheduler(
+        global_rate=env.float('TG_GLOBAL_RATE', GLOBAL_RATE) / env.int('TG_WORKERS', 1),
+        chat_rate=env.float('TG_CHAT_RATE', CHAT_RATE)
+    ))
+    fsm_state_ttl = env.int('FSM_STATE_TTL', FSM_STATE_TTL) or None
+    fsm_data_ttl = env.int('FSM_DATA_TTL', FSM_DATA_TTL) or None
+    if env.str('FSM_STORAGE', 'compact') == 'compact':
+        storage = CompactRedisStorage(redis_conn, state_ttl=fsm_state_ttl, data_ttl=fsm_data_ttl)
+    else:
+        storage = RedisStorage(redis=redis_conn, state_ttl=fsm_state_ttl, data_ttl=fsm_data_ttl)
     dp = Dispatcher(storage=storage)
+    setup_instrumentation(dp, bot, env.float('SLOW_UPDATE_THRESHOLD', SLOW_UPDATE_THRESHOLD))
+
+    photo_cache = PhotoCache(redis_conn)
+    photo_size = env.int('PHOTO_SIZE', PHOTO_SIZE)
+    image_cache_dir = env.str('IMAGE_CACHE_DIR', None)
+    image_memory_cache_mb = env.int('IMAGE_MEMORY_CACHE_MB', IMAGE_MEMORY_CACHE_BYTES // (1024 * 1024))
+    images = ProductImages(
+        strapi,
+        photo_size=photo_size,
+        transcoded=TranscodedImageCache(
+            image_cache_dir,
+            max_size=photo_size,
+            quality=env.int('PHOTO_QUALITY', PHOTO_QUALITY)
+        ) if image_cache_dir else None,
+        memory_cache=ImageByteCache(image_memory_cache_mb * 1024 * 1024) if image_memory_cache_mb else None,
+        views=ProductViews(redis_conn),
+        photo_cache=photo_cache,
+        prefetch_limit=env.int('IMAGE_PREFETCH_LIMIT', PREFETCH_LIMIT)
+    )
+
+    user_locks = UserLocks(redis_conn)
+    if cart_mode == 'redis':
+        cart_store = RedisCartStore(
+            redis_conn,
+            strapi,
+            catalog,
+            user_locks=user_locks,
+            flush_interval=cart_flush_interval
+        )
+    else:
+        cart_store = StrapiCartStore(strapi)
+
+    if cart_cache_ttl > 0:
+        cart_store = CachedCartStore(cart_store, redis_conn, ttl=cart_cache_ttl)
+
+    cart_store = LockedCartStore(cart_store, user_locks)
+
+    customers = CustomerResolver(redis_conn, strapi)
+    outbox = CheckoutOutbox(
+        redis_conn,
+        bot,
+        strapi,
+        cart_store,
+        customers,
+        user_locks,
+        max_attempts=env.int('CHECKOUT_MAX_ATTEMPTS', CHECKOUT_MAX_ATTEMPTS),
+        retry_delay=env.float('CHECKOUT_RETRY_DELAY', CHECKOUT_RETRY_DELAY)
+    )
+
+    register_handlers(
+        dp,
+        catalog,
+        bot,
+        images,
+        photo_cache,
+        cart_store,
+        outbox,
+        MenuKeyboardCache()
+    )
+
+    metrics_port = env.int('METRICS_PORT', METRICS_PORT)
+    metrics_runner = None
+    if metrics_port:
+        metrics_runner = await start_metrics_server(
+            env.str('METRICS_HOST', METRICS_HOST),
+            metrics_port,
+            profiler=Profiler(env.str('PROFILE_DIR', PROFILE_DIR))
+        )
 
-    register_handlers(dp, products, bot, strapi_base_url, strapi_token)
+    catalog_refresher.start(revalidate=warm_started)
+    cart_store.start()
+    outbox.start()
 
     try:
         logger.info("Бот запущен!")
-        await dp.start_polling(bot)
+        if bot_mode == 'webhook':
+            await run_webhook(
+                dp,
+                bot,
+                redis_conn,
+                catalog,
+                webhook_url=env.str('WEBHOOK_URL'),
+                webhook_path=env.str('WEBHOOK_PATH', WEBHOOK_PATH),
+                webhook_secret=env.str('WEBHOOK_SECRET', None),
+                host=env.str('WEBAPP_HOST', WEBAPP_HOST),
+                port=env.int('WEBAPP_PORT', WEBAPP_PORT),
+                shutdown_grace=env.float('WEBHOOK_SHUTDOWN_GRACE', SHUTDOWN_GRACE),
+                drain_timeout=env.float('WEBHOOK_DRAIN_TIMEOUT', DRAIN_TIMEOUT)
+            )
+        else:
+            await dp.start_polling(bot)
     finally:
+        await catalog_refresher.stop()
+        await outbox.stop()
+        await cart_store.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await strapi.close()
         await redis_conn.close()
 
 
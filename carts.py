@@ -0,0 +1,612 @@
+import asyncio
+import json
+import logging
+import socket
+import uuid
+from functools import partial
+from typing import Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import LockError, WatchError
+
+from catalog import CatalogStore
+from locks import UserLocks
+from metrics import REGISTRY
+from strapi_helpers import StrapiClient, StrapiError
+
+logger = logging.getLogger(__name__)
+
+cart_cache_counter = REGISTRY.counter(
+    "cart_cache_requests_total",
+    "Обращения к кэшу собранных корзин"
+)
+
+CART_FLUSH_INTERVAL = 5
+CART_FLUSH_BATCH_SIZE = 50
+CART_FLUSH_CONCURRENCY = 10
+CART_TTL = 30 * 24 * 60 * 60
+CART_SNAPSHOT_TTL = 30
+CART_GENERATION_TTL = 60 * 60
+
+CART_DIRTY_KEY = "cart:dirty"
+CART_FLUSHERS_KEY = "cart:flushers"
+CART_FLUSHER_TTL = 60
+
+
+def find_cart_item(cart: dict, product_document_id: str) -> Optional[dict]:
+    for item in cart.get('items') or []:
+        product = item.get('product')
+        if product and product.get('documentId') == product_document_id:
+            return item
+    return None
+
+
+async def compact_cart(strapi: StrapiClient, cart: dict) -> int:
+    """Сливает повторяющиеся строки одного товара в одну. Возвращает число удалённых строк."""
+    lines_by_product = {}
+    for item in cart.get('items') or []:
+        product = item.get('product')
+        if product:
+            lines_by_product.setdefault(product['documentId'], []).append(item)
+
+    removed = 0
+    for lines in lines_by_product.values():
+        if len(lines) < 2:
+            continue
+
+        first, *duplicates = lines
+        quantity = first.get('quantity', 0)
+        for line in duplicates:
+            # Переносим количество по одной строке: при сбое удаления откатываем,
+            # чтобы повторный запуск не посчитал строку дважды
+            merged_quantity = quantity + line.get('quantity', 0)
+            if not await strapi.update_cart_item_quantity(first['documentId'], merged_quantity):
+                break
+            if not await strapi.remove_cart_item(line['documentId']):
+                await strapi.update_cart_item_quantity(first['documentId'], quantity)
+                break
+            quantity = merged_quantity
+            removed += 1
+
+    return removed
+
+
+def cart_snapshot_key(telegram_id: int | str) -> str:
+    return f"cart_snapshot:{telegram_id}"
+
+
+def cart_generation_key(telegram_id: int | str) -> str:
+    return f"cart_generation:{telegram_id}"
+
+
+async def invalidate_cart_snapshot(redis: Redis, telegram_id: int | str):
+    """Сбрасывает снимок корзины и увеличивает её поколение, см. CachedCartStore."""
+    generation_key = cart_generation_key(telegram_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, CART_GENERATION_TTL)
+        pipe.delete(cart_snapshot_key(telegram_id))
+        await pipe.execute()
+
+
+def cart_keys(telegram_id: int | str) -> tuple[str, ...]:
+    """Все ключи Redis, в которых бот держит корзину пользователя."""
+    return (
+        RedisCartStore._items_key(telegram_id),
+        RedisCartStore._meta_key(telegram_id),
+        cart_snapshot_key(telegram_id),
+        cart_generation_key(telegram_id)
+    )
+
+
+class StrapiCartStore:
+    """Корзина живёт только в Strapi: каждое действие — запрос к API."""
+
+    def __init__(self, strapi: StrapiClient):
+        self.strapi = strapi
+
+    async def get_cart(self, telegram_id: int) -> Optional[dict]:
+        return await self.strapi.get_cart_with_items(telegram_id, stale_ok=True)
+
+    async def add_item(
+            self,
+            telegram_id: int,
+            product_document_id: str,
+            quantity: float = 1.0
+    ) -> bool:
+        try:
+            cart = await self.strapi.fetch_cart_with_items(telegram_id)
+        except StrapiError as e:
+            # Сбой чтения не значит, что корзины нет: вторую активную не создаём
+            logger.error(e)
+            return False
+        if not cart:
+            cart = await self.strapi.create_cart(telegram_id)
+
+        if not cart:
+            return False
+
+        existing_item = find_cart_item(cart, product_document_id)
+        if existing_item:
+            cart_item = await self.strapi.update_cart_item_quantity(
+                existing_item['documentId'],
+                existing_item.get('quantity', 0) + quantity
+            )
+        else:
+            cart_item = await self.strapi.add_product_to_cart(
+                cart['documentId'],
+                product_document_id,
+                quantity=quantity
+            )
+        return cart_item is not None
+
+    async def remove_item(self, telegram_id: int, item_id: str) -> bool:
+        return await self.strapi.remove_cart_item(item_id)
+
+    async def prepare_checkout(self, telegram_id: int) -> Optional[dict]:
+        """Актуальная корзина для оформления заказа.
+
+        None — активной корзины нет, сбой Strapi выбрасывается как StrapiError.
+        """
+        return await self.strapi.fetch_cart_with_items(telegram_id)
+
+    async def forget(self, telegram_id: int):
+        pass
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class RedisCartStore:
+    """Активная корзина хранится в Redis, а в Strapi записывается отложенно.
+
+    Каждое изменение помечает пользователя в множестве cart:dirty. Фоновая
+    задача пачками переносит помеченных пользователей в своё множество
+    cart:flushing:{воркер}, сводит их корзины со Strapi под блокировкой
+    пользователя и только после успешной записи снимает отметку.
+    Живой воркер продлевает ключ присутствия cart:flusher:{воркер};
+    если ключ истёк, воркер считается упавшим, и сверка возвращает его
+    cart:flushing в cart:dirty, так что изменения не теряются, а чужие
+    записи в процессе не трогаются.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            strapi: StrapiClient,
+            catalog: CatalogStore,
+            user_locks: Optional[UserLocks] = None,
+            flush_interval: float = CART_FLUSH_INTERVAL,
+            batch_size: int = CART_FLUSH_BATCH_SIZE,
+            concurrency: int = CART_FLUSH_CONCURRENCY
+    ):
+        self.redis = redis
+        self.strapi = strapi
+        self.catalog = catalog
+        self.user_locks = user_locks
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.flusher_name = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.flusher_ttl = max(CART_FLUSHER_TTL, int(flush_interval * 3))
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _items_key(telegram_id: int) -> str:
+        return f"cart:{telegram_id}:items"
+
+    @staticmethod
+    def _meta_key(telegram_id: int) -> str:
+        return f"cart:{telegram_id}:meta"
+
+    @staticmethod
+    def _flushing_key(flusher_name: str) -> str:
+        return f"cart:flushing:{flusher_name}"
+
+    @staticmethod
+    def _flusher_key(flusher_name: str) -> str:
+        return f"cart:flusher:{flusher_name}"
+
+    async def _load(self, telegram_id: int):
+        """Поднимает корзину из Strapi, если в Redis её ещё нет.
+
+        Ключи корзины под WATCH с проверки до записи: если пока шёл запрос
+        к Strapi корзину поднял и изменил параллельный вызов или её сбросило
+        оформление заказа, транзакция не выполнится, и состояние в Redis
+        не перетрётся устаревшей копией.
+        """
+        meta_key = self._meta_key(telegram_id)
+        if await self.redis.exists(meta_key):
+            return
+
+        items_key = self._items_key(telegram_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(meta_key, items_key)
+                    if await pipe.exists(meta_key):
+                        return
+
+                    cart = await self.strapi.fetch_cart_with_items(telegram_id)
+                    quantities = {}
+                    for item in (cart or {}).get('items') or []:
+                        product = item.get('product')
+                        if product:
+                            document_id = product['documentId']
+                            quantities[document_id] = quantities.get(document_id, 0) + item.get('quantity', 0)
+
+                    pipe.multi()
+                    pipe.hset(meta_key, "cart_document_id", cart['documentId'] if cart else "")
+                    if quantities:
+                        pipe.hset(items_key, mapping=quantities)
+                    pipe.expire(meta_key, CART_TTL)
+                    pipe.expire(items_key, CART_TTL)
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    async def _mutate(self, telegram_id: int, command: str, *args):
+        items_key = self._items_key(telegram_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            getattr(pipe, command)(items_key, *args)
+            pipe.expire(items_key, CART_TTL)
+            pipe.expire(self._meta_key(telegram_id), CART_TTL)
+            pipe.sadd(CART_DIRTY_KEY, telegram_id)
+            await pipe.execute()
+
+    async def get_cart(self, telegram_id: int) -> Optional[dict]:
+        try:
+            await self._load(telegram_id)
+        except StrapiError as e:
+            logger.error(e)
+            return None
+        raw_items = await self.redis.hgetall(self._items_key(telegram_id))
+
+        catalog = self.catalog.current
+        items = []
+        for raw_document_id, raw_quantity in raw_items.items():
+            document_id = raw_document_id.decode()
+            product = catalog.get_by_document_id(document_id)
+            if not product:
+                continue
+            items.append({
+                "documentId": document_id,
+                "quantity": float(raw_quantity),
+                "product": {
+                    "documentId": product.document_id,
+                    "title": product.title,
+                    "price": product.price
+                }
+            })
+
+        return {"items": items}
+
+    async def add_item(
+            self,
+            telegram_id: int,
+            product_document_id: str,
+            quantity: float = 1.0
+    ) -> bool:
+        try:
+            await self._load(telegram_id)
+        except StrapiError as e:
+            logger.error(e)
+            return False
+        await self._mutate(telegram_id, "hincrbyfloat", product_document_id, quantity)
+        return True
+
+    async def remove_item(self, telegram_id: int, item_id: str) -> bool:
+        try:
+            await self._load(telegram_id)
+        except StrapiError as e:
+            logger.error(e)
+            return False
+        await self._mutate(telegram_id, "hdel", item_id)
+        return True
+
+    async def prepare_checkout(self, telegram_id: int) -> Optional[dict]:
+        """Записывает корзину в Strapi и возвращает её оттуда.
+
+        None — корзина пуста, сбой записи выбрасывается как StrapiError.
+        """
+        await self.redis.srem(CART_DIRTY_KEY, telegram_id)
+        try:
+            await self._load(telegram_id)
+            if not await self.flush(telegram_id):
+                raise StrapiError(f"Не удалось записать корзину {telegram_id} в Strapi")
+        except StrapiError:
+            await self.redis.sadd(CART_DIRTY_KEY, telegram_id)
+            raise
+        return await self.strapi.fetch_cart_with_items(telegram_id)
+
+    async def forget(self, telegram_id: int):
+        await self.redis.delete(self._items_key(telegram_id), self._meta_key(telegram_id))
+
+    async def flush(self, telegram_id: int) -> bool:
+        """Приводит корзину в Strapi к состоянию корзины в Redis."""
+        raw_items = await self.redis.hgetall(self._items_key(telegram_id))
+        wanted = {
+            document_id.decode(): float(quantity)
+            for document_id, quantity in raw_items.items()
+            if float(quantity) > 0
+        }
+
+        cart = await self.strapi.fetch_cart_with_items(telegram_id)
+        if not cart:
+            if not wanted:
+                return True
+            cart = await self.strapi.create_cart(telegram_id)
+            if not cart:
+                return False
+            cart['items'] = []
+
+        await self.redis.hset(self._meta_key(telegram_id), "cart_document_id", cart['documentId'])
+
+        lines_by_product = {}
+        for item in cart.get('items') or []:
+            product = item.get('product')
+            document_id = product['documentId'] if product else None
+            lines_by_product.setdefault(document_id, []).append(item)
+
+        results = []
+        for document_id, lines in lines_by_product.items():
+            first, *duplicates = lines
+            for line in duplicates:
+                results.append(await self.strapi.remove_cart_item(line['documentId']))
+
+            quantity = wanted.pop(document_id, None)
+            if quantity is None:
+                results.append(await self.strapi.remove_cart_item(first['documentId']))
+            elif duplicates or first.get('quantity') != quantity:
+                updated = await self.strapi.update_cart_item_quantity(first['documentId'], quantity)
+                results.append(updated is not None)
+
+        for document_id, quantity in wanted.items():
+            created = await self.strapi.add_product_to_cart(cart['documentId'], document_id, quantity)
+            results.append(created is not None)
+
+        return all(results)
+
+    async def _flush_locked(self, telegram_id: int) -> bool:
+        if self.user_locks is None:
+            return await self.flush(telegram_id)
+        # Та же блокировка, что у оформления заказа: корзину в Strapi не создадут дважды
+        async with self.user_locks.hold(telegram_id):
+            return await self.flush(telegram_id)
+
+    async def _flush_one(self, telegram_id: int) -> bool:
+        flushing_key = self._flushing_key(self.flusher_name)
+        async with self._semaphore:
+            try:
+                flushed = await self._flush_locked(telegram_id)
+            except LockError:
+                logger.warning(f"Корзина {telegram_id} занята, синхронизируем позже")
+                flushed = False
+            except Exception:
+                logger.exception(f"Ошибка при синхронизации корзины {telegram_id}")
+                flushed = False
+
+        if flushed:
+            await self.redis.srem(flushing_key, telegram_id)
+        else:
+            await self.redis.smove(flushing_key, CART_DIRTY_KEY, telegram_id)
+        return flushed
+
+    async def heartbeat(self):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._flusher_key(self.flusher_name), 1, ex=self.flusher_ttl)
+            pipe.sadd(CART_FLUSHERS_KEY, self.flusher_name)
+            await pipe.execute()
+
+    async def flush_dirty(self) -> int:
+        """Синхронизирует очередную пачку корзин и возвращает число успешно записанных."""
+        await self.heartbeat()
+        flushing_key = self._flushing_key(self.flusher_name)
+        telegram_ids = []
+        # SMOVE переносит отметку атомарно: при падении воркера она остаётся
+        # в одном из множеств. Отметку, которую забрал другой воркер, пропускаем
+        for raw_telegram_id in await self.redis.srandmember(CART_DIRTY_KEY, self.batch_size):
+            if await self.redis.smove(CART_DIRTY_KEY, flushing_key, raw_telegram_id):
+                telegram_ids.append(int(raw_telegram_id))
+
+        results = await asyncio.gather(*(
+            self._flush_one(telegram_id) for telegram_id in telegram_ids
+        ))
+        return sum(results)
+
+    async def _requeue(self, flushing_key: str):
+        stuck = await self.redis.smembers(flushing_key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if stuck:
+                pipe.sadd(CART_DIRTY_KEY, *stuck)
+            pipe.delete(flushing_key)
+            await pipe.execute()
+        if stuck:
+            logger.info(f"Возвращаем в очередь корзины, запись которых прервалась: {len(stuck)}")
+
+    async def reconcile(self):
+        """Возвращает в очередь корзины упавших воркеров. Записи живых воркеров не трогает."""
+        for raw_name in await self.redis.smembers(CART_FLUSHERS_KEY):
+            flusher_name = raw_name.decode()
+            if flusher_name == self.flusher_name or await self.redis.exists(self._flusher_key(flusher_name)):
+                continue
+            await self._requeue(self._flushing_key(flusher_name))
+            await self.redis.srem(CART_FLUSHERS_KEY, flusher_name)
+
+    async def run(self):
+        await self.heartbeat()
+        while True:
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception("Ошибка при сверке очереди корзин")
+            await asyncio.sleep(self.flush_interval)
+            try:
+                while await self.flush_dirty() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Ошибка при синхронизации корзин")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        while await self.flush_dirty():
+            pass
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._flusher_key(self.flusher_name))
+            pipe.srem(CART_FLUSHERS_KEY, self.flusher_name)
+            await pipe.execute()
+
+
+class CachedCartStore:
+    """Кэширует собранную корзину пользователя в Redis на короткое время.
+
+    Повторные просмотры корзины не ходят в Strapi. Любое изменение
+    корзины через этот объект сбрасывает снимок и увеличивает поколение
+    корзины. Прочитанная корзина кладётся в кэш, только если поколение
+    за время чтения не изменилось, иначе медленное чтение вернуло бы
+    в кэш корзину до изменения. Оформление заказа всегда читает корзину
+    мимо кэша.
+    """
+
+    def __init__(self, store: 'CartStore', redis: Redis, ttl: int = CART_SNAPSHOT_TTL):
+        self.store = store
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(telegram_id: int) -> str:
+        return cart_snapshot_key(telegram_id)
+
+    async def invalidate(self, telegram_id: int):
+        await invalidate_cart_snapshot(self.redis, telegram_id)
+
+    async def get_cart(self, telegram_id: int) -> Optional[dict]:
+        key = self._key(telegram_id)
+        snapshot = await self.redis.get(key)
+        if snapshot is not None:
+            cart_cache_counter.inc(result="hit")
+            return json.loads(snapshot)
+
+        cart_cache_counter.inc(result="miss")
+        generation_key = cart_generation_key(telegram_id)
+        generation = await self.redis.get(generation_key)
+        cart = await self.store.get_cart(telegram_id)
+        if cart is None:
+            return None
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(generation_key)
+                if await pipe.get(generation_key) == generation:
+                    pipe.multi()
+                    pipe.set(key, json.dumps(cart, ensure_ascii=False), ex=self.ttl)
+                    await pipe.execute()
+            except WatchError:
+                pass
+        return cart
+
+    async def add_item(
+            self,
+            telegram_id: int,
+            product_document_id: str,
+            quantity: float = 1.0
+    ) -> bool:
+        try:
+            return await self.store.add_item(telegram_id, product_document_id, quantity)
+        finally:
+            await self.invalidate(telegram_id)
+
+    async def remove_item(self, telegram_id: int, item_id: str) -> bool:
+        try:
+            return await self.store.remove_item(telegram_id, item_id)
+        finally:
+            await self.invalidate(telegram_id)
+
+    async def prepare_checkout(self, telegram_id: int) -> Optional[dict]:
+        return await self.store.prepare_checkout(telegram_id)
+
+    async def forget(self, telegram_id: int):
+        try:
+            await self.store.forget(telegram_id)
+        finally:
+            await self.invalidate(telegram_id)
+
+    def start(self):
+        self.store.start()
+
+    async def stop(self):
+        await self.store.stop()
+
+
+class LockedCartStore:
+    """Пропускает изменения корзины через блокировку пользователя и single-flight.
+
+    Двойное нажатие «Добавить в корзину» или одновременная обработка
+    апдейтов разными воркерами превращаются в одно обращение к Strapi,
+    а поиск и создание активной корзины не выполняются параллельно.
+    """
+
+    def __init__(self, store: 'CartStore', locks: UserLocks):
+        self.store = store
+        self.locks = locks
+
+    async def get_cart(self, telegram_id: int) -> Optional[dict]:
+        return await self.store.get_cart(telegram_id)
+
+    async def add_item(
+            self,
+            telegram_id: int,
+            product_document_id: str,
+            quantity: float = 1.0
+    ) -> bool:
+        try:
+            return await self.locks.single_flight(
+                telegram_id,
+                "add_item",
+                partial(self.store.add_item, telegram_id),
+                product_document_id,
+                quantity
+            )
+        except LockError as e:
+            logger.error(f"Не удалось заблокировать корзину {telegram_id}: {e}")
+            return False
+
+    async def remove_item(self, telegram_id: int, item_id: str) -> bool:
+        try:
+            return await self.locks.single_flight(
+                telegram_id,
+                "remove_item",
+                partial(self.store.remove_item, telegram_id),
+                item_id
+            )
+        except LockError as e:
+            logger.error(f"Не удалось заблокировать корзину {telegram_id}: {e}")
+            return False
+
+    async def prepare_checkout(self, telegram_id: int) -> Optional[dict]:
+        return await self.store.prepare_checkout(telegram_id)
+
+    async def forget(self, telegram_id: int):
+        await self.store.forget(telegram_id)
+
+    def start(self):
+        self.store.start()
+
+    async def stop(self):
+        await self.store.stop()
+
+
+CartStore = StrapiCartStore | RedisCartStore | CachedCartStore | LockedCartStore
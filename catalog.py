@@ -0,0 +1,302 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+from metrics import REGISTRY
+from strapi_helpers import StrapiClient, StrapiError, get_media_attributes
+
+if TYPE_CHECKING:
+    from catalog_snapshot import CatalogSnapshot
+
+logger = logging.getLogger(__name__)
+
+CATALOG_REFRESH_INTERVAL = 60
+FULL_REFRESH_EVERY = 10
+
+catalog_version_gauge = REGISTRY.gauge(
+    "catalog_version",
+    "Номер текущей версии каталога"
+)
+catalog_products_gauge = REGISTRY.gauge(
+    "catalog_products",
+    "Количество товаров в текущей версии каталога"
+)
+catalog_refresh_interval_gauge = REGISTRY.gauge(
+    "catalog_refresh_interval_seconds",
+    "Интервал опроса Strapi за изменениями каталога"
+)
+catalog_sync_lag_gauge = REGISTRY.gauge(
+    "catalog_last_sync_lag_seconds",
+    "Сколько секунд прошло с последней успешной синхронизации каталога"
+)
+catalog_refresh_counter = REGISTRY.counter(
+    "catalog_refresh_total",
+    "Количество попыток обновления каталога"
+)
+
+
+class ImageVariant(NamedTuple):
+    """Уменьшенная копия картинки, которую Strapi строит при загрузке: thumbnail, small, medium..."""
+    url: str
+    width: int
+    height: int
+
+
+class ProductImage(NamedTuple):
+    """Ссылка на картинку товара: адрес и метка версии вместо всего медиаобъекта Strapi.
+
+    variants отсортированы от меньшей к большей, оригинал в них не входит.
+    """
+    url: str
+    version: str
+    variants: tuple[ImageVariant, ...] = ()
+
+    @classmethod
+    def from_strapi(cls, image_field: Optional[dict]) -> Optional['ProductImage']:
+        attributes = get_media_attributes(image_field)
+        if not attributes or not attributes.get('url'):
+            return None
+
+        variants = [
+            ImageVariant(url=variant['url'], width=variant['width'], height=variant['height'])
+            for variant in (attributes.get('formats') or {}).values()
+            if variant.get('url') and variant.get('width') and variant.get('height')
+        ]
+        variants.sort(key=lambda variant: max(variant.width, variant.height))
+
+        return cls(
+            url=attributes['url'],
+            version=attributes.get('hash') or attributes.get('updatedAt') or attributes['url'],
+            variants=tuple(variants)
+        )
+
+    def pick_url(self, min_size: int) -> str:
+        """Адрес самой лёгкой копии, у которой длинная сторона не меньше min_size."""
+        for variant in self.variants:
+            if max(variant.width, variant.height) >= min_size:
+                return variant.url
+        return self.url
+
+
+class Product(NamedTuple):
+    """Товар в каталоге. Кортеж без словаря атрибутов: держит только то, что показывает бот."""
+    document_id: str
+    short_id: str
+    title: str
+    price: float
+    description: str
+    image: Optional[ProductImage]
+    updated_at: Optional[str]
+
+    @classmethod
+    def from_strapi(cls, product: dict) -> 'Product':
+        return cls(
+            document_id=product['documentId'],
+            short_id=make_short_id(product['documentId']),
+            title=product.get('title'),
+            price=product.get('price'),
+            description=product.get('description'),
+            image=ProductImage.from_strapi(product.get('image')),
+            updated_at=product.get('updatedAt')
+        )
+
+
+def make_short_id(document_id: str) -> str:
+    """Короткий стабильный идентификатор для callback_data: не зависит от порядка товаров."""
+    digest = hashlib.blake2b(document_id.encode(), digest_size=5).digest()
+    return base64.b32encode(digest).decode().lower()
+
+
+@dataclass(frozen=True)
+class Catalog:
+    """Неизменяемая версия каталога. Обновление создаёт новый объект."""
+    products: tuple[Product, ...]
+    version: int = 0
+    synced_at: Optional[str] = None
+    by_document_id: dict = field(init=False, repr=False, compare=False)
+    by_short_id: dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(
+            self,
+            'by_document_id',
+            {product.document_id: product for product in self.products}
+        )
+        object.__setattr__(
+            self,
+            'by_short_id',
+            {product.short_id: product for product in self.products}
+        )
+        if len(self.by_short_id) != len(self.products):
+            logger.warning("Совпадение коротких идентификаторов товаров в каталоге")
+
+    def get_by_document_id(self, document_id: str) -> Optional[Product]:
+        return self.by_document_id.get(document_id)
+
+    def get_by_short_id(self, short_id: str) -> Optional[Product]:
+        return self.by_short_id.get(short_id)
+
+
+def get_latest_update(products) -> Optional[str]:
+    timestamps = [product.updated_at for product in products if product.updated_at]
+    return max(timestamps) if timestamps else None
+
+
+def merge_products(products: tuple, updated_products: list) -> tuple:
+    updated_by_id = {product.document_id: product for product in updated_products}
+    merged = [
+        updated_by_id.pop(product.document_id, product)
+        for product in products
+    ]
+    merged.extend(updated_by_id.values())
+    return tuple(merged)
+
+
+class CatalogStore:
+    """Держит текущую версию каталога и атомарно подменяет её целиком."""
+
+    def __init__(self, catalog: Optional[Catalog] = None):
+        self._catalog = catalog or Catalog(products=())
+        self.last_sync_monotonic: Optional[float] = None
+        catalog_sync_lag_gauge.set_function(self.sync_lag)
+
+    @property
+    def current(self) -> Catalog:
+        return self._catalog
+
+    def swap(self, catalog: Catalog):
+        self._catalog = catalog
+        catalog_version_gauge.set(catalog.version)
+        catalog_products_gauge.set(len(catalog.products))
+
+    def mark_synced(self):
+        self.last_sync_monotonic = time.monotonic()
+
+    def sync_lag(self) -> float:
+        if self.last_sync_monotonic is None:
+            return -1
+        return time.monotonic() - self.last_sync_monotonic
+
+
+class CatalogRefresher:
+    """Фоновый опрос Strapi: забирает только товары, изменённые после прошлой синхронизации.
+
+    Удалённые товары инкрементальный запрос не видит, поэтому раз в
+    full_refresh_every циклов каталог перезагружается целиком.
+    Каждая новая версия сохраняется в snapshot, если он задан, чтобы
+    следующий запуск мог стартовать с неё, не дожидаясь Strapi.
+    """
+
+    def __init__(
+            self,
+            strapi: StrapiClient,
+            strapi_url: str,
+            store: CatalogStore,
+            interval: float = CATALOG_REFRESH_INTERVAL,
+            full_refresh_every: int = FULL_REFRESH_EVERY,
+            snapshot: Optional['CatalogSnapshot'] = None
+    ):
+        self.strapi = strapi
+        self.strapi_url = strapi_url
+        self.store = store
+        self.interval = interval
+        self.full_refresh_every = full_refresh_every
+        self.snapshot = snapshot
+        self._cycles = 0
+        self._task: Optional[asyncio.Task] = None
+        catalog_refresh_interval_gauge.set(interval)
+
+    async def refresh(self, full: bool = False) -> bool:
+        current = self.store.current
+        updated_after = None if full else current.synced_at
+
+        fetched = []
+        try:
+            async for page in self.strapi.iter_product_pages(
+                    self.strapi_url,
+                    updated_after=updated_after
+            ):
+                fetched.extend(Product.from_strapi(product) for product in page)
+        except StrapiError as e:
+            logger.error(f"Ошибка при обновлении каталога: {e}")
+            catalog_refresh_counter.inc(result="error")
+            return False
+
+        self.store.mark_synced()
+
+        if full:
+            products = tuple(fetched)
+        elif fetched:
+            products = merge_products(current.products, fetched)
+        else:
+            catalog_refresh_counter.inc(result="unchanged")
+            return True
+
+        if full and products == current.products:
+            catalog_refresh_counter.inc(result="unchanged")
+            return True
+
+        catalog = Catalog(
+            products=products,
+            version=current.version + 1,
+            synced_at=get_latest_update(products) or current.synced_at
+        )
+        self.store.swap(catalog)
+        catalog_refresh_counter.inc(result="updated")
+        logger.info(
+            f"Каталог обновлён до версии {catalog.version}, "
+            f"товаров: {len(products)}, изменено: {len(fetched)}"
+        )
+
+        if self.snapshot is not None:
+            await self.snapshot.save(catalog)
+        return True
+
+    async def warm_start(self) -> bool:
+        """Подставляет каталог из последнего снимка. Синхронизацией со Strapi это не считается."""
+        if self.snapshot is None:
+            return False
+
+        catalog = await self.snapshot.load()
+        if catalog is None or not catalog.products:
+            return False
+
+        self.store.swap(catalog)
+        logger.info(
+            f"Каталог версии {catalog.version} загружен из снимка, "
+            f"товаров: {len(catalog.products)}, изменения от {catalog.synced_at}"
+        )
+        return True
+
+    async def run(self, revalidate: bool = False):
+        if revalidate:
+            try:
+                await self.refresh(full=True)
+            except Exception:
+                logger.exception("Ошибка при сверке каталога со Strapi")
+
+        while True:
+            await asyncio.sleep(self.interval)
+            self._cycles += 1
+            full = self._cycles % self.full_refresh_every == 0
+            try:
+                await self.refresh(full=full)
+            except Exception:
+                logger.exception("Ошибка при обновлении каталога")
+
+    def start(self, revalidate: bool = False):
+        """revalidate сразу сверяет каталог со Strapi, не дожидаясь первого интервала."""
+        self._task = asyncio.create_task(self.run(revalidate))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
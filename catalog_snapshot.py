@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import os
+import zlib
+from typing import Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from catalog import Catalog, ImageVariant, Product, ProductImage
+
+logger = logging.getLogger(__name__)
+
+CATALOG_SNAPSHOT_KEY = "catalog:snapshot"
+CATALOG_SNAPSHOT_PATH = "catalog_snapshot.json.z"
+# Меняется вместе с полями Product: снимок старого формата не загружается
+SNAPSHOT_FORMAT = 3
+
+
+def dump_catalog(catalog: Catalog) -> bytes:
+    """Сжатый JSON: товары хранятся списками значений полей Product без имён ключей."""
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "version": catalog.version,
+        "synced_at": catalog.synced_at,
+        "products": [list(product) for product in catalog.products]
+    }
+    return zlib.compress(json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def load_product(fields: list) -> Product:
+    product = Product._make(fields)
+    if product.image is not None:
+        url, version, variants = product.image
+        product = product._replace(image=ProductImage(
+            url=url,
+            version=version,
+            variants=tuple(ImageVariant._make(variant) for variant in variants)
+        ))
+    return product
+
+
+def load_catalog(payload: bytes) -> Optional[Catalog]:
+    try:
+        snapshot = json.loads(zlib.decompress(payload))
+    except (zlib.error, ValueError) as e:
+        logger.error(f"Снимок каталога повреждён: {e}")
+        return None
+
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        logger.warning(f"Снимок каталога в формате {snapshot.get('format')}, ожидался {SNAPSHOT_FORMAT}")
+        return None
+
+    return Catalog(
+        products=tuple(load_product(fields) for fields in snapshot['products']),
+        version=snapshot['version'],
+        synced_at=snapshot['synced_at']
+    )
+
+
+class RedisCatalogSnapshot:
+    """Последняя версия каталога в общем Redis: её подхватывают все воркеры."""
+
+    def __init__(self, redis: Redis, key: str = CATALOG_SNAPSHOT_KEY):
+        self.redis = redis
+        self.key = key
+
+    async def load(self) -> Optional[Catalog]:
+        try:
+            payload = await self.redis.get(self.key)
+        except RedisError as e:
+            logger.error(f"Не удалось прочитать снимок каталога: {e}")
+            return None
+        return load_catalog(payload) if payload else None
+
+    async def save(self, catalog: Catalog):
+        try:
+            await self.redis.set(self.key, dump_catalog(catalog))
+        except RedisError as e:
+            logger.error(f"Не удалось сохранить снимок каталога: {e}")
+
+
+class FileCatalogSnapshot:
+    """Снимок каталога в локальном файле, для запуска без Redis с данными."""
+
+    def __init__(self, path: str = CATALOG_SNAPSHOT_PATH):
+        self.path = path
+
+    def _read(self) -> Optional[bytes]:
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                return snapshot_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, payload: bytes):
+        # Пишем во временный файл и подменяем, чтобы не оставить недописанный снимок
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(payload)
+        os.replace(temporary_path, self.path)
+
+    async def load(self) -> Optional[Catalog]:
+        try:
+            payload = await asyncio.to_thread(self._read)
+        except OSError as e:
+            logger.error(f"Не удалось прочитать снимок каталога: {e}")
+            return None
+        return load_catalog(payload) if payload else None
+
+    async def save(self, catalog: Catalog):
+        try:
+            await asyncio.to_thread(self._write, dump_catalog(catalog))
+        except OSError as e:
+            logger.error(f"Не удалось сохранить снимок каталога: {e}")
+
+
+CatalogSnapshot = RedisCatalogSnapshot | FileCatalogSnapshot
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import socket
+import uuid
+from typing import Optional
+
+from aiogram import Bot
+from redis.asyncio import Redis
+from redis.exceptions import LockError, ResponseError
+
+from carts import CartStore
+from customers import CustomerResolver
+from locks import UserLocks
+from metrics import REGISTRY
+from send_scheduler import bulk_priority
+from strapi_helpers import StrapiClient, StrapiError, StrapiRejectedError
+
+logger = logging.getLogger(__name__)
+
+CHECKOUT_STREAM = "checkout:outbox"
+CHECKOUT_GROUP = "checkout-workers"
+CHECKOUT_MAX_ATTEMPTS = 8
+CHECKOUT_RETRY_DELAY = 15
+CHECKOUT_BATCH_SIZE = 20
+CHECKOUT_ORDER_TTL = 7 * 24 * 60 * 60
+CHECKOUT_PENDING_TTL = 60 * 60
+# Дольше худшего прохода: повторы запросов к Strapi, ожидание блокировки пользователя и запись
+CHECKOUT_LEASE_TIMEOUT = 120
+
+# Заявка ставится целиком или не ставится вовсе: без отметки о заказе
+# в оформлении, ссылающейся на заказ, которого нет в очереди
+ENQUEUE_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    return existing
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('HSET', KEYS[2],
+    'telegram_id', ARGV[4], 'chat_id', ARGV[5], 'email', ARGV[6], 'username', ARGV[7],
+    'attempts', 0, 'status', 'pending')
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('XADD', KEYS[3], '*', 'order_id', ARGV[1])
+return ARGV[1]
+"""
+
+checkout_counter = REGISTRY.counter(
+    "checkout_orders_total",
+    "Заказы, прошедшие через очередь оформления"
+)
+
+
+class CheckoutFailed(Exception):
+    """Заказ нельзя оформить, повтор не поможет."""
+
+
+class CheckoutOutbox:
+    """Очередь оформления заказов в Redis Stream.
+
+    Обработчик только записывает намерение оформить заказ и сразу отвечает
+    пользователю. Фоновый воркер выполняет запись в Strapi и сообщает
+    результат. Записи подтверждаются (XACK) только после успеха или
+    окончательной ошибки, поэтому незавершённые заказы переживают
+    перезапуск: их подберёт XAUTOCLAIM любого воркера. Проход по заказу
+    держит аренду в Redis, поэтому запись, подобранная другим воркером,
+    пока первый ещё работает, пропускается. Корзина, выбранная
+    для заказа, запоминается в записи заказа, так что повтор после сбоя
+    завершает ту же корзину, а не ищет новую.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            bot: Bot,
+            strapi: StrapiClient,
+            cart_store: CartStore,
+            customers: CustomerResolver,
+            user_locks: UserLocks,
+            max_attempts: int = CHECKOUT_MAX_ATTEMPTS,
+            retry_delay: float = CHECKOUT_RETRY_DELAY,
+            batch_size: int = CHECKOUT_BATCH_SIZE,
+            lease_timeout: float = CHECKOUT_LEASE_TIMEOUT
+    ):
+        self.redis = redis
+        self.bot = bot
+        self.strapi = strapi
+        self.cart_store = cart_store
+        self.customers = customers
+        self.user_locks = user_locks
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.lease_timeout = lease_timeout
+        self.consumer_name = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self._enqueue_script = redis.register_script(ENQUEUE_SCRIPT)
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _order_key(order_id: str) -> str:
+        return f"checkout:order:{order_id}"
+
+    @staticmethod
+    def _lease_key(order_id: str) -> str:
+        return f"checkout:lease:{order_id}"
+
+    @staticmethod
+    def _pending_key(telegram_id: int | str) -> str:
+        return f"checkout:pending:{telegram_id}"
+
+    async def enqueue(
+            self,
+            telegram_id: int,
+            chat_id: int,
+            email: str,
+            username: Optional[str] = None
+    ) -> str:
+        """Ставит заказ в очередь. Повторная отправка email, пока заказ
+        не оформлен, возвращает уже созданный заказ."""
+        order_id = uuid.uuid4().hex
+        queued_order_id = await self._enqueue_script(
+            keys=[self._pending_key(telegram_id), self._order_key(order_id), CHECKOUT_STREAM],
+            args=[order_id, CHECKOUT_PENDING_TTL, CHECKOUT_ORDER_TTL, telegram_id, chat_id, email, username or ""]
+        )
+        queued_order_id = queued_order_id.decode()
+        if queued_order_id != order_id:
+            return queued_order_id
+
+        checkout_counter.inc(result="enqueued")
+        logger.info(f"Заказ {order_id} поставлен в очередь для telegram_id: {telegram_id}")
+        return order_id
+
+    async def _complete(self, order_id: str, order: dict):
+        telegram_id = int(order['telegram_id'])
+
+        customer = await self.customers.resolve(
+            telegram_id,
+            order['email'],
+            order['username'] or None
+        )
+        if not customer:
+            raise StrapiError(f"Не удалось получить клиента для заказа {order_id}")
+
+        cart_document_id = order.get('cart')
+        if not cart_document_id:
+            cart = await self.cart_store.prepare_checkout(telegram_id)
+            if not cart or not cart.get('items'):
+                raise CheckoutFailed("Ваша корзина пуста")
+            cart_document_id = cart['documentId']
+            await self.redis.hset(self._order_key(order_id), "cart", cart_document_id)
+
+        try:
+            completed = await self.strapi.link_cart_to_customer_and_complete(
+                cart_document_id,
+                customer['documentId']
+            )
+        except StrapiRejectedError:
+            # Клиент из кэша мог быть удалён в Strapi, например dedupe-customers,
+            # а корзина — удалена sweep-carts. Следующая попытка найдёт обоих заново
+            await self.customers.forget(telegram_id)
+            await self.redis.hdel(self._order_key(order_id), "cart")
+            raise
+        if not completed:
+            raise StrapiError(f"Не удалось завершить корзину {cart_document_id}")
+
+        await self.cart_store.forget(telegram_id)
+
+    async def _finish(self, entry_id: bytes, order_id: str, order: dict, status: str, text: str):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._order_key(order_id), "status", status)
+            pipe.delete(self._pending_key(order['telegram_id']))
+            pipe.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, entry_id)
+            pipe.xdel(CHECKOUT_STREAM, entry_id)
+            await pipe.execute()
+
+        checkout_counter.inc(result=status)
+        # Уведомление фонового воркера не должно задерживать ответы на нажатия
+        with bulk_priority():
+            await self.bot.send_message(chat_id=int(order['chat_id']), text=text)
+
+    async def _load_order(self, order_id: str) -> Optional[dict]:
+        raw_order = await self.redis.hgetall(self._order_key(order_id))
+        if not raw_order:
+            return None
+        return {key.decode(): value.decode() for key, value in raw_order.items()}
+
+    async def process(self, entry_id: bytes, fields: dict):
+        order_id = fields[b'order_id'].decode()
+        lease = self.redis.lock(self._lease_key(order_id), timeout=self.lease_timeout, blocking=False)
+        if not await lease.acquire(token=self.consumer_name):
+            # Заказ сейчас оформляет другой воркер, запись вернётся к нему или к нам позже
+            return
+
+        try:
+            await self._process_leased(entry_id, order_id)
+        finally:
+            try:
+                # Снимается только своя аренда: истёкшую мог уже взять другой воркер
+                await lease.release()
+            except LockError:
+                logger.warning(f"Аренда заказа {order_id} истекла до конца прохода")
+
+    async def _process_leased(self, entry_id: bytes, order_id: str):
+        order = await self._load_order(order_id)
+        if order is None:
+            logger.error(f"Заказ {order_id} не найден, убираем из очереди")
+            await self.redis.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, entry_id)
+            return
+
+        if order['status'] != "pending":
+            await self.redis.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, entry_id)
+            return
+
+        attempts = await self.redis.hincrby(self._order_key(order_id), "attempts", 1)
+        try:
+            async with self.user_locks.hold(int(order['telegram_id'])):
+                # Пока ждали блокировку, заказ мог завершить прошлый проход
+                order = await self._load_order(order_id)
+                if order is None or order['status'] != "pending":
+                    await self.redis.xack(CHECKOUT_STREAM, CHECKOUT_GROUP, entry_id)
+                    return
+                await self._complete(order_id, order)
+        except CheckoutFailed as e:
+            await self._finish(entry_id, order_id, order, "failed", f"Не удалось оформить заказ: {e}")
+            return
+        except (StrapiError, LockError) as e:
+            logger.warning(f"Заказ {order_id}, попытка {attempts}: {e}")
+            if attempts >= self.max_attempts:
+                await self._finish(
+                    entry_id,
+                    order_id,
+                    order,
+                    "failed",
+                    "Не удалось оформить заказ, попробуйте ещё раз позже."
+                )
+            # Без XACK запись останется в очереди и вернётся через retry_delay
+            return
+
+        await self._finish(
+            entry_id,
+            order_id,
+            order,
+            "completed",
+            f"Ваш заказ оформлен.\nМы свяжемся с вами по адресу: {order['email']}"
+        )
+
+    async def _ensure_group(self):
+        try:
+            await self.redis.xgroup_create(CHECKOUT_STREAM, CHECKOUT_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _process_batch(self, entries: list):
+        results = await asyncio.gather(
+            *(self.process(entry_id, fields) for entry_id, fields in entries if fields),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при обработке заказа: {result!r}")
+
+    async def run(self):
+        await self._ensure_group()
+        while True:
+            try:
+                # Сначала подбираем зависшие записи: повторы и заказы упавших воркеров
+                _, claimed, *_ = await self.redis.xautoclaim(
+                    CHECKOUT_STREAM,
+                    CHECKOUT_GROUP,
+                    self.consumer_name,
+                    min_idle_time=int(self.retry_delay * 1000),
+                    count=self.batch_size
+                )
+                if claimed:
+                    await self._process_batch(claimed)
+
+                response = await self.redis.xreadgroup(
+                    CHECKOUT_GROUP,
+                    self.consumer_name,
+                    {CHECKOUT_STREAM: ">"},
+                    count=self.batch_size,
+                    block=int(self.retry_delay * 1000)
+                )
+                for _, entries in response or []:
+                    await self._process_batch(entries)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка в очереди оформления заказов")
+                await asyncio.sleep(self.retry_delay)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,90 @@
+import logging
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from metrics import REGISTRY
+from strapi_helpers import StrapiClient, StrapiError
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_CACHE_TTL = 30 * 24 * 60 * 60
+
+customer_cache_counter = REGISTRY.counter(
+    "customer_cache_requests_total",
+    "Обращения к кэшу клиентов по telegram_id"
+)
+
+
+def customer_cache_key(telegram_id: int | str) -> str:
+    return f"customer:{telegram_id}"
+
+
+class CustomerResolver:
+    """Находит клиента по telegram_id или создаёт его, запоминая результат в Redis.
+
+    Повторный покупатель с тем же email не требует ни одного запроса
+    к Strapi. Если email изменился, запись клиента обновляется, а не
+    создаётся новая.
+    """
+
+    def __init__(self, redis: Redis, strapi: StrapiClient, ttl: int = CUSTOMER_CACHE_TTL):
+        self.redis = redis
+        self.strapi = strapi
+        self.ttl = ttl
+
+    async def _remember(self, telegram_id: int, customer: dict):
+        key = customer_cache_key(telegram_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={
+                "documentId": customer['documentId'],
+                "email": customer.get('email') or "",
+                "username": customer.get('username') or ""
+            })
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def _cached(self, telegram_id: int) -> Optional[dict]:
+        cached = await self.redis.hgetall(customer_cache_key(telegram_id))
+        if not cached:
+            return None
+        return {
+            "documentId": cached[b'documentId'].decode(),
+            "email": cached.get(b'email', b'').decode(),
+            "username": cached.get(b'username', b'').decode() or None
+        }
+
+    async def resolve(
+            self,
+            telegram_id: int,
+            email: str,
+            username: Optional[str] = None
+    ) -> Optional[dict]:
+        customer = await self._cached(telegram_id)
+        if customer:
+            customer_cache_counter.inc(result="hit")
+        else:
+            customer_cache_counter.inc(result="miss")
+            try:
+                customer = await self.strapi.fetch_customer(telegram_id)
+            except StrapiError as e:
+                logger.error(e)
+                return None
+
+        if not customer:
+            customer = await self.strapi.create_customer(telegram_id, email, username)
+            if not customer:
+                return None
+        elif customer.get('email') != email or customer.get('username') != username:
+            updated = await self.strapi.update_customer(customer['documentId'], email, username)
+            if not updated:
+                # Запись могла быть удалена или слита с дублем — в следующий раз спросим Strapi
+                await self.forget(telegram_id)
+                return None
+            customer = updated
+
+        await self._remember(telegram_id, customer)
+        return customer
+
+    async def forget(self, telegram_id: int | str):
+        await self.redis.delete(customer_cache_key(telegram_id))
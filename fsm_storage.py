@@ -0,0 +1,153 @@
+import json
+import re
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisEventIsolation
+from redis.asyncio import Redis
+
+FSM_STATE_TTL = 30 * 24 * 60 * 60
+FSM_DATA_TTL = 30 * 24 * 60 * 60
+# Не "data": под этим именем RedisStorage хранит данные строкой с JSON
+FSM_DATA_PART = "vars"
+
+_STR_TAG = b"s"
+_INT_TAG = b"i"
+_JSON_TAG = b"j"
+
+_VARIABLE_KEY_PART = re.compile(r"^-?\d+$|^[A-Za-z0-9_-]{16,}$")
+
+
+def pack_value(value: Any) -> bytes:
+    """Значение поля данных FSM: байт типа и само значение без обёртки JSON для строк и чисел."""
+    if isinstance(value, str):
+        return _STR_TAG + value.encode()
+    if isinstance(value, int) and not isinstance(value, bool):
+        return _INT_TAG + str(value).encode()
+    return _JSON_TAG + json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def unpack_value(packed: bytes) -> Any:
+    tag, payload = packed[:1], packed[1:]
+    if tag == _STR_TAG:
+        return payload.decode()
+    if tag == _INT_TAG:
+        return int(payload)
+    return json.loads(payload)
+
+
+def key_pattern(key: str) -> str:
+    """Шаблон ключа для отчёта о памяти: telegram_id, documentId и прочие идентификаторы заменяются на *."""
+    return ":".join("*" if _VARIABLE_KEY_PART.match(part) else part for part in key.split(":"))
+
+
+class CompactRedisStorage(BaseStorage):
+    """Хранилище FSM в Redis с ограниченным сроком жизни ключей.
+
+    Состояние лежит строкой, как в RedisStorage, поэтому после переключения
+    пользователи остаются в своих состояниях. Данные лежат хэшем: каждое
+    поле — отдельное значение, упакованное pack_value. Короткие хэши Redis
+    хранит в компактном listpack, а update_data пишет только изменённые
+    поля и не читает данные перед записью.
+
+    Каждая запись продлевает срок жизни своего ключа, так что ключи
+    пропавших пользователей удаляются сами через state_ttl и data_ttl.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            key_builder: Optional[KeyBuilder] = None,
+            state_ttl: Optional[int] = FSM_STATE_TTL,
+            data_ttl: Optional[int] = FSM_DATA_TTL
+    ):
+        self.redis = redis
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.state_ttl = state_ttl or None
+        self.data_ttl = data_ttl or None
+
+    def create_isolation(self, **kwargs: Any) -> RedisEventIsolation:
+        return RedisEventIsolation(redis=self.redis, key_builder=self.key_builder, **kwargs)
+
+    async def close(self):
+        await self.redis.aclose(close_connection_pool=True)
+
+    def _state_key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key, "state")
+
+    def _data_key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key, FSM_DATA_PART)
+
+    def _queue_state(self, pipe, key: StorageKey, state: StateType):
+        if state is None:
+            pipe.delete(self._state_key(key))
+        else:
+            pipe.set(
+                self._state_key(key),
+                state.state if isinstance(state, State) else state,
+                ex=self.state_ttl
+            )
+
+    def _queue_data(self, pipe, key: StorageKey, data: Mapping[str, Any]):
+        data_key = self._data_key(key)
+        pipe.hset(data_key, mapping={field: pack_value(value) for field, value in data.items()})
+        if self.data_ttl:
+            pipe.expire(data_key, self.data_ttl)
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self._queue_state(pipe, key, state)
+            await pipe.execute()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        value = await self.redis.get(self._state_key(key))
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._data_key(key))
+            if data:
+                self._queue_data(pipe, key, data)
+            await pipe.execute()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        packed = await self.redis.hgetall(self._data_key(key))
+        return {field.decode(): unpack_value(value) for field, value in packed.items()}
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        packed = await self.redis.hget(self._data_key(storage_key), dict_key)
+        return default if packed is None else unpack_value(packed)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        if not data:
+            return await self.get_data(key)
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_data(pipe, key, data)
+            pipe.hgetall(self._data_key(key))
+            *_, packed = await pipe.execute()
+        return {field.decode(): unpack_value(value) for field, value in packed.items()}
+
+    async def set_state_and_update_data(self, key: StorageKey, state: StateType, data: Mapping[str, Any]):
+        """Меняет состояние и дописывает данные за один запрос к Redis."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_state(pipe, key, state)
+            if data:
+                self._queue_data(pipe, key, data)
+            await pipe.execute()
+
+
+async def set_state_with_data(state: FSMContext, new_state: StateType, **data: Any):
+    """set_state и update_data одним запросом, если хранилище это умеет, иначе по очереди."""
+    if isinstance(state.storage, CompactRedisStorage):
+        await state.storage.set_state_and_update_data(state.key, new_state, data)
+        return
+
+    await state.update_data(**data)
+    await state.set_state(new_state)
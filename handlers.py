@@ -1,4 +1,10 @@
+import logging
+import math
+from functools import cache
+from typing import Optional
+
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
@@ -6,19 +12,21 @@ from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     CallbackQuery,
-    BufferedInputFile
+    BufferedInputFile,
+    InputMediaPhoto
 )
 
-from strapi_helpers import (
-    get_image_url,
-    download_image,
-    get_cart,
-    create_cart,
-    add_product_to_cart,
-    get_cart_with_items,
-    remove_cart_item,
-    create_customer,link_cart_to_customer_and_complete
-)
+from carts import CartStore
+from catalog import Catalog, CatalogStore, Product
+from checkout import CheckoutOutbox
+from fsm_storage import set_state_with_data
+from photo_cache import PhotoCache
+from product_images import ProductImages
+from telegram_session import PreparedKeyboard
+
+logger = logging.getLogger(__name__)
+
+MENU_PAGE_SIZE = 8
 
 
 class BotStates(StatesGroup):
@@ -29,13 +37,40 @@ class BotStates(StatesGroup):
     WAITING_EMAIL = State()
 
 
-def get_keyboard(buttons: list, prefix: str = "option"):
+def get_keyboard(
+        products: tuple,
+        page: int = 0,
+        page_size: int = MENU_PAGE_SIZE
+):
+    page_count = max(1, math.ceil(len(products) / page_size))
+    page = min(max(page, 0), page_count - 1)
+    start = page * page_size
+
     keyboard = []
-    for idx, button in enumerate(buttons):
+    for product in products[start:start + page_size]:
         keyboard.append([InlineKeyboardButton(
-            text=button,
-            callback_data=f"{prefix}_{idx}"
+            text=product.title,
+            callback_data=f"product_{product.short_id}"
         )])
+
+    if page_count > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(
+                text="←",
+                callback_data=f"menu_page_{page - 1}"
+            ))
+        navigation.append(InlineKeyboardButton(
+            text=f"{page + 1}/{page_count}",
+            callback_data=f"menu_page_{page}"
+        ))
+        if page < page_count - 1:
+            navigation.append(InlineKeyboardButton(
+                text="→",
+                callback_data=f"menu_page_{page + 1}"
+            ))
+        keyboard.append(navigation)
+
     keyboard.append([InlineKeyboardButton(
         text="Моя корзина",
         callback_data="show_cart"
@@ -43,6 +78,36 @@ def get_keyboard(buttons: list, prefix: str = "option"):
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+class MenuKeyboardCache:
+    """Готовые клавиатуры меню для текущей версии каталога.
+
+    Клавиатура страницы строится и сериализуется в JSON один раз на версию
+    каталога. Как только обработчик видит новую версию, кэш сбрасывается целиком.
+    """
+
+    def __init__(self, page_size: int = MENU_PAGE_SIZE):
+        self.page_size = page_size
+        self._version: Optional[int] = None
+        self._keyboards: dict[int, PreparedKeyboard] = {}
+
+    def get(self, catalog: Catalog, page: int = 0) -> PreparedKeyboard:
+        if catalog.version != self._version:
+            self._keyboards = {}
+            self._version = catalog.version
+
+        page_count = max(1, math.ceil(len(catalog.products) / self.page_size))
+        page = min(max(page, 0), page_count - 1)
+
+        keyboard = self._keyboards.get(page)
+        if keyboard is None:
+            keyboard = PreparedKeyboard.from_markup(
+                get_keyboard(catalog.products, page=page, page_size=self.page_size)
+            )
+            self._keyboards[page] = keyboard
+        return keyboard
+
+
+@cache
 def get_back_keyboard():
     keyboard = [
         [InlineKeyboardButton(
@@ -85,6 +150,7 @@ def get_cart_keyboard(cart_items: list):
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@cache
 def get_empty_cart_keyboard():
     keyboard = [[InlineKeyboardButton(
         text="Назад",
@@ -93,13 +159,140 @@ def get_empty_cart_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-async def cmd_start(message: Message, state: FSMContext, products: list):
-    if not products:
+async def delete_message(bot: Bot, message: Message):
+    """Удаляет сообщение, которое заменяется новым. Неудача не мешает показу нового."""
+    try:
+        await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось удалить сообщение: {e}")
+
+
+async def show_text(
+        bot: Bot,
+        message: Message,
+        text: str,
+        reply_markup: InlineKeyboardMarkup
+):
+    """Показывает текст на месте сообщения с кнопками.
+
+    Текстовое сообщение редактируется. Фото в текст превратить нельзя,
+    поэтому только в этом случае сообщение удаляется и отправляется заново.
+    """
+    if not message.photo:
+        try:
+            await bot.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=message.message_id,
+                text=text,
+                reply_markup=reply_markup
+            )
+            return
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                return
+            logger.warning(f"Не удалось отредактировать сообщение: {e}")
+
+    await delete_message(bot, message)
+    await bot.send_message(chat_id=message.chat.id, text=text, reply_markup=reply_markup)
+
+
+async def show_photo(
+        bot: Bot,
+        message: Message,
+        photo: str | BufferedInputFile,
+        caption: str,
+        reply_markup: InlineKeyboardMarkup
+) -> Optional[Message]:
+    """Показывает фото на месте сообщения: фото меняется через edit_message_media,
+    текст удаляется и заменяется новым сообщением с фото."""
+    if message.photo:
+        edited = await bot.edit_message_media(
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            media=InputMediaPhoto(media=photo, caption=caption),
+            reply_markup=reply_markup
+        )
+        return edited if isinstance(edited, Message) else None
+
+    sent_message = await bot.send_photo(
+        chat_id=message.chat.id,
+        photo=photo,
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    await delete_message(bot, message)
+    return sent_message
+
+
+async def show_product_photo(
+        bot: Bot,
+        message: Message,
+        product: Product,
+        caption: str,
+        images: ProductImages,
+        photo_cache: PhotoCache
+) -> bool:
+    file_id = await photo_cache.get(product)
+
+    if file_id:
+        try:
+            await show_photo(bot, message, file_id, caption, get_back_keyboard())
+            return True
+        except TelegramBadRequest as e:
+            logger.warning(f"Telegram отклонил file_id товара {product.document_id}: {e}")
+            await photo_cache.invalidate(product)
+
+    image_data = await images.fetch(product)
+    if not image_data:
+        return False
+
+    photo = BufferedInputFile(image_data, filename="product.jpg")
+    sent_message = await show_photo(bot, message, photo, caption, get_back_keyboard())
+    if sent_message and sent_message.photo:
+        await photo_cache.set(product, sent_message.photo[-1].file_id)
+
+    return True
+
+
+def render_cart(cart: Optional[dict]) -> tuple[str, InlineKeyboardMarkup]:
+    if not cart or not cart.get('items'):
+        return "Ваша корзина пуста", get_empty_cart_keyboard()
+
+    cart_text = "Ваша корзина:\n\n"
+    total_price = 0
+
+    for item in cart['items']:
+        product = item.get('product')
+        quantity = item.get('quantity', 0)
+
+        if product:
+            title = product.get('title', 'Неизвестный товар')
+            price = product.get('price', 0)
+            item_total = price * quantity
+            total_price += item_total
+
+            cart_text += f"{title}\n"
+            cart_text += f"{quantity} кг × {price} руб. = {item_total} руб.\n\n"
+
+    cart_text += f"Итого: {total_price} руб."
+
+    return cart_text, get_cart_keyboard(cart['items'])
+
+
+async def cmd_start(
+        message: Message,
+        state: FSMContext,
+        catalog: CatalogStore,
+        images: ProductImages,
+        menu_keyboards: MenuKeyboardCache
+):
+    current_catalog = catalog.current
+    if not current_catalog.products:
         await message.answer("Извините, товары временно недоступны.")
         return
 
-    product_names = [product.get('title') for product in products]
-    reply_markup = get_keyboard(product_names, prefix='product')
+    images.schedule_prefetch(current_catalog)
+    reply_markup = menu_keyboards.get(current_catalog)
 
     await message.answer(text='Привет! Выберите товар:', reply_markup=reply_markup)
     await state.set_state(BotStates.HANDLE_MENU)
@@ -108,57 +301,41 @@ async def cmd_start(message: Message, state: FSMContext, products: list):
 async def main_menu_handler(
         callback: CallbackQuery,
         state: FSMContext,
-        products: list,
+        catalog: CatalogStore,
         bot: Bot,
-        strapi_base_url: str
+        images: ProductImages,
+        photo_cache: PhotoCache
 ):
-    product_id = int(callback.data.split('_')[1])
-
-    if 0 <= product_id < len(products):
-        product = products[product_id]
-
-        await state.update_data(current_product_document_id=product.get('documentId'))
+    short_id = callback.data.split('_', 1)[1]
+    product = catalog.current.get_by_short_id(short_id)
 
+    if product:
         caption = (
-            f"{product.get('title')} "
-            f"({product.get('price')} руб. за кг)\n\n"
-            f"{product.get('description')}"
+            f"{product.title} "
+            f"({product.price} руб. за кг)\n\n"
+            f"{product.description}"
         )
 
-        image_url = get_image_url(product, strapi_base_url)
-
         await callback.answer()
-        await bot.delete_message(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id
+
+        photo_shown = await show_product_photo(
+            bot,
+            callback.message,
+            product,
+            caption,
+            images,
+            photo_cache
         )
 
-        if image_url:
-            image_data = download_image(image_url)
-
-            if image_data:
-                photo = BufferedInputFile(image_data, filename="product.jpg")
-
-                await bot.send_photo(
-                    chat_id=callback.message.chat.id,
-                    photo=photo,
-                    caption=caption,
-                    reply_markup=get_back_keyboard()
-                )
-            else:
-                await bot.send_message(
-                    chat_id=callback.message.chat.id,
-                    text=caption,
-                    reply_markup=get_back_keyboard()
-                )
-        else:
-            await bot.send_message(
-                chat_id=callback.message.chat.id,
-                text=caption,
-                reply_markup=get_back_keyboard()
-            )
+        if not photo_shown:
+            await show_text(bot, callback.message, caption, get_back_keyboard())
 
-        await state.set_state(BotStates.HANDLE_DESCRIPTION)
+        await set_state_with_data(
+            state,
+            BotStates.HANDLE_DESCRIPTION,
+            current_product_document_id=product.document_id
+        )
+        await images.record_view(product)
     else:
         await callback.answer("Ошибка: товар не найден")
 
@@ -166,59 +343,54 @@ async def main_menu_handler(
 async def back_to_menu_handler(
         callback: CallbackQuery,
         state: FSMContext,
-        products: list,
-        bot: Bot
+        catalog: CatalogStore,
+        bot: Bot,
+        images: ProductImages,
+        menu_keyboards: MenuKeyboardCache
 ):
-    product_names = [product.get('title') for product in products]
-    reply_markup = get_keyboard(product_names, prefix='product')
+    images.schedule_prefetch(catalog.current)
+    reply_markup = menu_keyboards.get(catalog.current)
 
     await callback.answer()
-    await bot.delete_message(
-        chat_id=callback.message.chat.id,
-        message_id=callback.message.message_id
-    )
-
-    await bot.send_message(
-        chat_id=callback.message.chat.id,
-        text='Выберите товар:',
-        reply_markup=reply_markup
-    )
+    await show_text(bot, callback.message, 'Выберите товар:', reply_markup)
     await state.set_state(BotStates.HANDLE_MENU)
 
 
+async def menu_page_handler(
+        callback: CallbackQuery,
+        catalog: CatalogStore,
+        images: ProductImages,
+        menu_keyboards: MenuKeyboardCache
+):
+    page = int(callback.data.split('_')[2])
+
+    images.schedule_prefetch(catalog.current)
+    await callback.answer()
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=menu_keyboards.get(catalog.current, page)
+        )
+    except TelegramBadRequest:
+        # Нажата кнопка текущей страницы — разметка не изменилась
+        pass
+
+
 async def add_to_cart_handler(
         callback: CallbackQuery,
         state: FSMContext,
-        strapi_base_url: str,
-        strapi_token: str
+        cart_store: CartStore
 ):
     telegram_id = callback.from_user.id
 
-    cart = get_cart(strapi_base_url, strapi_token, telegram_id)
-    if not cart:
-        cart = create_cart(strapi_base_url, strapi_token, telegram_id)
-
-    if not cart:
-        await callback.answer("Ошибка при создании корзины", show_alert=True)
-        return
-
-    user_data = await state.get_data()
-    product_document_id = user_data.get('current_product_document_id')
+    product_document_id = await state.get_value('current_product_document_id')
 
     if not product_document_id:
         await callback.answer("Ошибка: товар не выбран", show_alert=True)
         return
 
-    cart_document_id = cart['documentId']
-    cart_item = add_product_to_cart(
-        strapi_base_url,
-        strapi_token,
-        cart_document_id,
-        product_document_id,
-        quantity=1.0
-    )
+    added = await cart_store.add_item(telegram_id, product_document_id, quantity=1.0)
 
-    if cart_item:
+    if added:
         await callback.answer("Товар добавлен в корзину!")
     else:
         await callback.answer("Ошибка при добавлении товара в корзину", show_alert=True)
@@ -227,109 +399,37 @@ async def add_to_cart_handler(
 async def show_cart_handler(
         callback: CallbackQuery,
         state: FSMContext,
-        strapi_base_url: str,
-        strapi_token: str,
+        cart_store: CartStore,
         bot: Bot
 ):
     telegram_id = callback.from_user.id
 
-    cart = get_cart_with_items(strapi_base_url, strapi_token, telegram_id)
+    cart = await cart_store.get_cart(telegram_id)
+    cart_text, reply_markup = render_cart(cart)
 
     await callback.answer()
-    await bot.delete_message(
-        chat_id=callback.message.chat.id,
-        message_id=callback.message.message_id
-    )
-
-    if not cart or not cart.get('items'):
-        await bot.send_message(
-            chat_id=callback.message.chat.id,
-            text="Ваша корзина пуста",
-            reply_markup=get_empty_cart_keyboard()
-        )
-        await state.set_state(BotStates.HANDLE_CART)
-        return
-
-    cart_text = "Ваша корзина:\n\n"
-    total_price = 0
-
-    for item in cart['items']:
-        product = item.get('product')
-        quantity = item.get('quantity', 0)
-
-        if product:
-            title = product.get('title', 'Неизвестный товар')
-            price = product.get('price', 0)
-            item_total = price * quantity
-            total_price += item_total
-
-            cart_text += f"{title}\n"
-            cart_text += f"{quantity} кг × {price} руб. = {item_total} руб.\n\n"
-
-    cart_text += f"Итого: {total_price} руб."
-
-    await bot.send_message(
-        chat_id=callback.message.chat.id,
-        text=cart_text,
-        reply_markup=get_cart_keyboard(cart['items'])
-    )
-
+    await show_text(bot, callback.message, cart_text, reply_markup)
     await state.set_state(BotStates.HANDLE_CART)
 
 
 async def remove_item_handler(
         callback: CallbackQuery,
         state: FSMContext,
-        strapi_base_url: str,
-        strapi_token: str,
+        cart_store: CartStore,
         bot: Bot
 ):
     item_document_id = callback.data.split('_')[2]
+    telegram_id = callback.from_user.id
 
-    success = remove_cart_item(strapi_base_url, strapi_token, item_document_id)
+    success = await cart_store.remove_item(telegram_id, item_document_id)
 
     if success:
-        telegram_id = callback.from_user.id
-        cart = get_cart_with_items(strapi_base_url, strapi_token, telegram_id)
+        cart = await cart_store.get_cart(telegram_id)
+        cart_text, reply_markup = render_cart(cart)
 
         await callback.answer("Товар удален из корзины")
-        await bot.delete_message(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id
-        )
-
-        if not cart or not cart.get('items'):
-            await bot.send_message(
-                chat_id=callback.message.chat.id,
-                text="Ваша корзина пуста",
-                reply_markup=get_empty_cart_keyboard()
-            )
-            await state.set_state(BotStates.HANDLE_CART)
-            return
-
-        cart_text = "Ваша корзина:\n\n"
-        total_price = 0
-
-        for item in cart['items']:
-            product = item.get('product')
-            quantity = item.get('quantity', 0)
-
-            if product:
-                title = product.get('title', 'Неизвестный товар')
-                price = product.get('price', 0)
-                item_total = price * quantity
-                total_price += item_total
-
-                cart_text += f"{title}\n"
-                cart_text += f"{quantity} кг × {price} руб. = {item_total} руб.\n\n"
-
-        cart_text += f"Итого: {total_price} руб."
-
-        await bot.send_message(
-            chat_id=callback.message.chat.id,
-            text=cart_text,
-            reply_markup=get_cart_keyboard(cart['items'])
-        )
+        await show_text(bot, callback.message, cart_text, reply_markup)
+        await state.set_state(BotStates.HANDLE_CART)
     else:
         await callback.answer("Ошибка при удалении товара", show_alert=True)
 
@@ -342,30 +442,19 @@ async def pay_handler(callback: CallbackQuery, state: FSMContext):
     await state.set_state(BotStates.WAITING_EMAIL)
 
 
-async def email_handler(
-        message: Message,
-        state: FSMContext,
-        strapi_base_url: str,
-        strapi_token: str
-):
+async def email_handler(message: Message, state: FSMContext, outbox: CheckoutOutbox):
     email = message.text
-    telegram_id = message.from_user.id
-    username = message.from_user.username
-
-    customer = create_customer(strapi_base_url, strapi_token, telegram_id, email, username)
-
-    if customer:
-        cart = get_cart_with_items(strapi_base_url, strapi_token, telegram_id)
-        if cart:
-            link_cart_to_customer_and_complete(
-                strapi_base_url,
-                strapi_token,
-                cart['documentId'],
-                customer['documentId']
-            )
+
+    await outbox.enqueue(
+        message.from_user.id,
+        message.chat.id,
+        email,
+        message.from_user.username
+    )
+
     await message.answer(
-        f"Спасибо! Ваш заказ оформлен.\n"
-        f"Мы свяжемся с вами по адресу: {email}"
+        "Спасибо! Заказ принят.\n"
+        "Пришлём подтверждение, как только он будет оформлен."
     )
 
     await state.set_state(BotStates.HANDLE_MENU)
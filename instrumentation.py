@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType
+)
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+from metrics import REGISTRY, Registry
+from tracing import SLOW_UPDATE_THRESHOLD, Profiler, current_trace, span, trace_update
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_PROFILE_SECONDS = 30
+
+handler_duration_histogram = REGISTRY.histogram(
+    "bot_handler_duration_seconds",
+    "Длительность обработки апдейта обработчиком"
+)
+handler_error_counter = REGISTRY.counter(
+    "bot_handler_errors_total",
+    "Исключения, выброшенные обработчиками"
+)
+telegram_duration_histogram = REGISTRY.histogram(
+    "telegram_request_duration_seconds",
+    "Длительность запросов к Bot API без ожидания в очереди отправки"
+)
+telegram_error_counter = REGISTRY.counter(
+    "telegram_request_errors_total",
+    "Запросы к Bot API, завершившиеся ошибкой"
+)
+
+
+def handler_name(handler: HandlerObject) -> str:
+    """Имя функции обработчика, в том числе обёрнутой в partial."""
+    callback = getattr(handler.callback, 'func', handler.callback)
+    return getattr(callback, '__name__', type(callback).__name__)
+
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """Открывает трассу на каждый апдейт; медленные апдейты попадают в лог со всеми шагами."""
+
+    def __init__(self, slow_threshold: float = SLOW_UPDATE_THRESHOLD):
+        self.slow_threshold = slow_threshold
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: dict[str, Any]
+    ) -> Any:
+        with trace_update(event.update_id, event.event_type, self.slow_threshold):
+            return await handler(event, data)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Замеряет каждый сработавший обработчик и считает его исключения."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any]
+    ) -> Any:
+        name = handler_name(data['handler'])
+        trace = current_trace.get()
+        if trace is not None:
+            trace.handler = name
+
+        with handler_duration_histogram.time(handler=name):
+            try:
+                return await handler(event, data)
+            except Exception as e:
+                handler_error_counter.inc(handler=name, error=type(e).__name__)
+                raise
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Замеряет запросы к Bot API по методам.
+
+    Подключается к сессии после SendScheduler, чтобы время ожидания
+    в очереди отправки не попадало в замер.
+    """
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        method_name = type(method).__name__
+        with telegram_duration_histogram.time(method=method_name), span(f"telegram.{method_name}"):
+            try:
+                return await make_request(bot, method)
+            except Exception as e:
+                telegram_error_counter.inc(method=method_name, error=type(e).__name__)
+                raise
+
+
+def setup_instrumentation(dp: Dispatcher, bot: Bot, slow_update_threshold: float = SLOW_UPDATE_THRESHOLD):
+    dp.update.outer_middleware(UpdateTracingMiddleware(slow_update_threshold))
+    timing = HandlerTimingMiddleware()
+    dp.message.middleware(timing)
+    dp.callback_query.middleware(timing)
+    bot.session.middleware(TelegramTimingMiddleware())
+
+
+def build_metrics_app(registry: Registry = REGISTRY, profiler: Optional[Profiler] = None) -> web.Application:
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            body=registry.render().encode(),
+            headers={"Content-Type": METRICS_CONTENT_TYPE}
+        )
+
+    async def profile(request: web.Request) -> web.Response:
+        """POST /debug/profile?seconds=N: профилирует живой трафик N секунд и отдаёт сводку."""
+        try:
+            seconds = float(request.query.get('seconds', DEFAULT_PROFILE_SECONDS))
+        except ValueError:
+            return web.Response(text="seconds должно быть числом\n", status=400)
+        seconds = min(max(seconds, 1), profiler.max_seconds)
+
+        try:
+            profiler.start()
+        except RuntimeError as e:
+            return web.Response(text=f"{e}\n", status=409)
+
+        logger.info(f"Профилирование на {seconds} с")
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            path, summary = profiler.stop()
+        return web.Response(text=f"Профиль: {path}\n\n{summary}")
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    if profiler is not None:
+        app.router.add_post('/debug/profile', profile)
+    return app
+
+
+async def start_metrics_server(
+        host: str = METRICS_HOST,
+        port: int = METRICS_PORT,
+        profiler: Optional[Profiler] = None
+) -> web.AppRunner:
+    """Поднимает отдельный HTTP-сервер с метриками в формате Prometheus.
+
+    Если передан profiler, там же доступен запуск профилирования.
+    Сервер слушает локальный адрес, поэтому отдельной авторизации у него нет.
+    """
+    runner = web.AppRunner(build_metrics_app(profiler=profiler), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable
+
+from redis.asyncio import Redis
+from redis.asyncio.lock import Lock
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 30
+LOCK_BLOCKING_TIMEOUT = 10
+DEDUP_WINDOW = 1.0
+
+
+class UserLocks:
+    """Распределённые блокировки по telegram_id и single-flight для действий пользователя.
+
+    Одинаковые одновременные вызовы внутри процесса ждут одну и ту же
+    задачу. Между воркерами действия пользователя упорядочивает блокировка
+    в Redis, а результат выполненного действия ещё dedup_window секунд
+    отдаётся повторным одинаковым вызовам вместо нового запроса в Strapi.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            lock_timeout: float = LOCK_TIMEOUT,
+            blocking_timeout: float = LOCK_BLOCKING_TIMEOUT,
+            dedup_window: float = DEDUP_WINDOW
+    ):
+        self.redis = redis
+        self.lock_timeout = lock_timeout
+        self.blocking_timeout = blocking_timeout
+        self.dedup_window = dedup_window
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    def hold(self, telegram_id: int) -> Lock:
+        return self.redis.lock(
+            f"user_lock:{telegram_id}",
+            timeout=self.lock_timeout,
+            blocking_timeout=self.blocking_timeout
+        )
+
+    async def single_flight(
+            self,
+            telegram_id: int,
+            operation: str,
+            function: Callable[..., Awaitable[Any]],
+            *args
+    ) -> Any:
+        key = ":".join(str(part) for part in (telegram_id, operation, *args))
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run_locked(key, telegram_id, function, args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _run_locked(
+            self,
+            key: str,
+            telegram_id: int,
+            function: Callable[..., Awaitable[Any]],
+            args: tuple
+    ) -> Any:
+        result_key = f"single_flight:{key}"
+
+        async with self.hold(telegram_id):
+            shared_result = await self.redis.get(result_key)
+            if shared_result is not None:
+                logger.info(f"Повторный запрос {key} получил результат уже выполненного")
+                return json.loads(shared_result)
+
+            result = await function(*args)
+            await self.redis.set(
+                result_key,
+                json.dumps(result),
+                px=int(self.dedup_window * 1000)
+            )
+            return result
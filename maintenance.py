@@ -0,0 +1,459 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from environs import Env
+from redis.asyncio import Redis
+from redis.exceptions import LockError
+
+from carts import cart_keys, compact_cart, invalidate_cart_snapshot
+from catalog import Product
+from customers import customer_cache_key
+from fsm_storage import FSM_DATA_TTL, key_pattern
+from locks import UserLocks
+from product_images import IMAGE_CACHE_DIR, PHOTO_QUALITY, PHOTO_SIZE, ProductImages, TranscodedImageCache
+from strapi_helpers import StrapiClient, StrapiError
+
+logger = logging.getLogger(__file__)
+
+SWEEP_CHECKPOINT_KEY = "maintenance:sweep_carts"
+ABANDONED_STATUS = "abandoned"
+
+
+async def compact_carts(strapi: StrapiClient, redis: Redis, args: argparse.Namespace):
+    """Сливает повторяющиеся строки в активных корзинах.
+
+    Каждая корзина обрабатывается под блокировкой пользователя, как
+    изменения корзины в боте. Под блокировкой корзина перечитывается:
+    страница могла устареть, пока до неё дошла очередь. Снимок корзины
+    после слияния сбрасывается.
+    """
+    user_locks = UserLocks(redis)
+    page = 1
+    carts_seen = 0
+    lines_removed = 0
+    carts_busy = 0
+
+    while True:
+        carts_response = await strapi.get_active_carts(page=page, page_size=args.page_size)
+        if not carts_response or 'data' not in carts_response:
+            logger.error(f"Не удалось загрузить страницу корзин {page}, останавливаемся")
+            break
+
+        for listed_cart in carts_response['data']:
+            telegram_id = listed_cart.get('telegram_id')
+            try:
+                async with user_locks.hold(telegram_id):
+                    cart = await strapi.fetch_cart_with_items(telegram_id)
+                    if not cart or cart['documentId'] != listed_cart['documentId']:
+                        # Корзину уже оформили или удалили
+                        continue
+                    removed = await compact_cart(strapi, cart)
+                    if removed:
+                        await invalidate_cart_snapshot(redis, telegram_id)
+            except LockError:
+                logger.warning(f"Корзина пользователя {telegram_id} занята, пропускаем")
+                carts_busy += 1
+                continue
+            except StrapiError as e:
+                logger.error(f"Не удалось перечитать корзину пользователя {telegram_id}: {e}")
+                continue
+            lines_removed += removed
+        carts_seen += len(carts_response['data'])
+
+        pagination = carts_response.get('meta', {}).get('pagination', {})
+        if page >= pagination.get('pageCount', 1):
+            break
+        page += 1
+
+    logger.info(f"Проверено корзин: {carts_seen}, слито строк: {lines_removed}, занятых пропущено: {carts_busy}")
+
+
+async def merge_customers(strapi: StrapiClient, customers: list) -> int:
+    """Переносит корзины дублей к самой ранней записи клиента и удаляет дубли. Возвращает число удалённых."""
+    keeper, *duplicates = customers
+    latest = duplicates[-1]
+    if latest.get('email') != keeper.get('email'):
+        await strapi.update_customer(keeper['documentId'], latest.get('email'), latest.get('username'))
+
+    removed = 0
+    for duplicate in duplicates:
+        moved = [
+            await strapi.set_cart_customer(cart['documentId'], keeper['documentId'])
+            for cart in duplicate.get('carts') or []
+        ]
+        if all(moved) and await strapi.delete_customer(duplicate['documentId']):
+            removed += 1
+    return removed
+
+
+async def dedupe_customers(strapi: StrapiClient, redis: Redis, args: argparse.Namespace):
+    """Оставляет по одному клиенту на telegram_id: самую раннюю запись.
+
+    Корзины дублей переносятся к оставленной записи, ей же достаётся
+    email из самой свежей, после чего дубли удаляются. Клиенты одного
+    пользователя сливаются под его блокировкой, чтобы не столкнуться
+    с оформлением заказа.
+    """
+    customers_by_telegram_id = {}
+    page = 1
+    while True:
+        customers_response = await strapi.get_customers(page=page, page_size=args.page_size)
+        if not customers_response or 'data' not in customers_response:
+            logger.error(f"Не удалось загрузить страницу клиентов {page}, дубли не тронуты")
+            return
+
+        for customer in customers_response['data']:
+            customers_by_telegram_id.setdefault(customer.get('telegram_id'), []).append(customer)
+
+        pagination = customers_response.get('meta', {}).get('pagination', {})
+        if page >= pagination.get('pageCount', 1):
+            break
+        page += 1
+
+    user_locks = UserLocks(redis)
+    removed = 0
+    for telegram_id, customers in customers_by_telegram_id.items():
+        if not telegram_id or len(customers) < 2:
+            continue
+
+        try:
+            async with user_locks.hold(telegram_id):
+                removed += await merge_customers(strapi, customers)
+                await redis.delete(customer_cache_key(telegram_id))
+                await invalidate_cart_snapshot(redis, telegram_id)
+        except LockError:
+            logger.warning(f"Пользователь {telegram_id} сейчас оформляет заказ, его клиенты не тронуты")
+
+    logger.info(f"Клиентов: {len(customers_by_telegram_id)}, удалено дублей: {removed}")
+
+
+async def prepare_images(strapi: StrapiClient, redis: Redis, args: argparse.Namespace):
+    """Пережимает картинки каталога в локальный кэш, из которого их отдаёт бот."""
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logger.error("Для подготовки картинок нужен Pillow: uv sync --extra images")
+        return
+
+    if not args.strapi_url:
+        logger.error("Не задан адрес списка товаров: STRAPI_URL или --strapi-url")
+        return
+
+    cache = TranscodedImageCache(args.cache_dir, max_size=args.photo_size, quality=args.quality)
+    images = ProductImages(strapi, photo_size=args.photo_size)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = {"prepared": 0, "skipped": 0, "failed": 0}
+
+    async def prepare(product: Product):
+        if product.image is None:
+            return
+        if not args.force and cache.contains(product.image):
+            results["skipped"] += 1
+            return
+
+        async with semaphore:
+            data = await strapi.download_image(images.url_for(product.image))
+            if not data:
+                results["failed"] += 1
+                return
+            try:
+                transcoded = await cache.put(product.image, data)
+            except Exception as e:
+                logger.error(f"Не удалось пережать картинку товара {product.document_id}: {e}")
+                results["failed"] += 1
+                return
+
+        results["prepared"] += 1
+        logger.info(f"{product.title}: {len(data)} -> {len(transcoded)} байт")
+
+    try:
+        async for page in strapi.iter_product_pages(args.strapi_url):
+            await asyncio.gather(*(prepare(Product.from_strapi(product)) for product in page))
+    except StrapiError as e:
+        logger.error(f"Не удалось загрузить каталог: {e}")
+
+    logger.info(
+        f"Пережато: {results['prepared']}, уже в кэше: {results['skipped']}, "
+        f"с ошибкой: {results['failed']}"
+    )
+
+
+async def redis_memory(strapi: StrapiClient, redis: Redis, args: argparse.Namespace):
+    """Сводка по памяти Redis в разрезе шаблонов ключей: сколько ключей, байт и ключей без TTL.
+
+    Ключи обходятся через SCAN, размер и TTL запрашиваются пачками в одном
+    конвейере, поэтому отчёт можно снимать на живой базе.
+    """
+    patterns = {}
+
+    async def measure(keys: list):
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key)
+                pipe.ttl(key)
+            results = await pipe.execute()
+
+        for key, size, ttl in zip(keys, results[::2], results[1::2]):
+            if size is None:
+                # Ключ успел истечь между SCAN и замером
+                continue
+            pattern = key_pattern(key.decode(errors='replace'))
+            stats = patterns.setdefault(pattern, {"keys": 0, "bytes": 0, "persistent": 0})
+            stats["keys"] += 1
+            stats["bytes"] += size
+            if ttl == -1:
+                stats["persistent"] += 1
+
+    batch = []
+    async for key in redis.scan_iter(match=args.match, count=args.batch_size):
+        batch.append(key)
+        if len(batch) >= args.batch_size:
+            await measure(batch)
+            batch = []
+    if batch:
+        await measure(batch)
+
+    total_keys = sum(stats["keys"] for stats in patterns.values())
+    total_bytes = sum(stats["bytes"] for stats in patterns.values())
+    print(f"{'шаблон':<40} {'ключей':>10} {'байт':>14} {'в среднем':>10} {'без TTL':>10}")
+    for pattern, stats in sorted(patterns.items(), key=lambda item: item[1]["bytes"], reverse=True)[:args.top]:
+        print(
+            f"{pattern:<40} {stats['keys']:>10} {stats['bytes']:>14} "
+            f"{stats['bytes'] // stats['keys']:>10} {stats['persistent']:>10}"
+        )
+    print(f"{'всего':<40} {total_keys:>10} {total_bytes:>14}")
+
+
+async def expire_persistent(strapi: StrapiClient, redis: Redis, args: argparse.Namespace):
+    """Выставляет TTL ключам без срока жизни, чей шаблон начинается с args.prefix.
+
+    Без --apply только считает такие ключи. EXPIRE NX не трогает ключи,
+    которым срок жизни успели выставить после SCAN.
+    """
+    found = 0
+    expired = 0
+
+    async def expire_batch(keys: list):
+        nonlocal found, expired
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.ttl(key)
+            ttls = await pipe.execute()
+
+        persistent = [
+            key for key, ttl in zip(keys, ttls)
+            if ttl == -1 and key_pattern(key.decode(errors='replace')).startswith(args.prefix)
+        ]
+        found += len(persistent)
+        if not args.apply or not persistent:
+            return
+
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in persistent:
+                pipe.expire(key, args.ttl, nx=True)
+            expired += sum(await pipe.execute())
+
+    batch = []
+    async for key in redis.scan_iter(match=args.match, count=args.batch_size):
+        batch.append(key)
+        if len(batch) >= args.batch_size:
+            await expire_batch(batch)
+            batch = []
+    if batch:
+        await expire_batch(batch)
+
+    if args.apply:
+        logger.info(f"Ключей {args.prefix}* без срока жизни: {found}, выставлен TTL {args.ttl} с: {expired}")
+    else:
+        logger.info(f"Ключей {args.prefix}* без срока жизни: {found}. Ничего не изменено, для записи запустите с --apply")
+
+
+async def sweep_cart(strapi: StrapiClient, cart: dict, mode: str) -> bool:
+    if mode == 'archive':
+        return await strapi.set_cart_status(cart['documentId'], ABANDONED_STATUS) is not None
+
+    # Строки удаляем до корзины: если сбой, корзина останется и попадёт в следующий запуск
+    for item in cart.get('items') or []:
+        if not await strapi.remove_cart_item(item['documentId']):
+            return False
+    return await strapi.delete_cart(cart['documentId'])
+
+
+async def sweep_carts(strapi: StrapiClient, redis: Redis, args: argparse.Namespace):
+    """Архивирует или удаляет активные корзины, в которых давно ничего не менялось.
+
+    Корзины читаются страницами по возрастанию id, страница обрабатывается
+    не больше чем concurrency запросами сразу. После каждой страницы
+    в Redis сохраняется последний id и граница давности, так что
+    прерванный запуск продолжается с того же места. Корзина пропускается,
+    если в ней есть свежие строки или пользователь сейчас что-то делает.
+    """
+    results = {"swept": 0, "skipped": 0, "failed": 0}
+    checkpoint = await redis.hgetall(SWEEP_CHECKPOINT_KEY)
+    if checkpoint and not args.restart:
+        after_id = int(checkpoint[b'after_id'])
+        updated_before = checkpoint[b'updated_before'].decode()
+        for name in results:
+            results[name] = int(checkpoint.get(name.encode(), 0))
+        logger.info(f"Продолжаем с корзины после id {after_id}, граница давности {updated_before}")
+    else:
+        after_id = 0
+        cutoff = datetime.now(timezone.utc) - timedelta(days=args.older_than_days)
+        updated_before = cutoff.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+    user_locks = UserLocks(redis)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    resumed = sum(results.values())
+    started = time.monotonic()
+
+    async def process(cart: dict):
+        items = cart.get('items') or []
+        if any((item.get('updatedAt') or '') >= updated_before for item in items):
+            results["skipped"] += 1
+            return
+        if args.dry_run:
+            results["swept"] += 1
+            return
+
+        telegram_id = cart.get('telegram_id')
+        async with semaphore:
+            try:
+                # Та же блокировка, что у корзины и оформления заказа в боте
+                async with user_locks.hold(telegram_id):
+                    swept = await sweep_cart(strapi, cart, args.mode)
+                    if swept and telegram_id:
+                        await redis.delete(*cart_keys(telegram_id))
+            except LockError:
+                results["skipped"] += 1
+                return
+
+        results["swept" if swept else "failed"] += 1
+
+    try:
+        async for page in strapi.iter_stale_cart_pages(updated_before, after_id, args.page_size):
+            await asyncio.gather(*(process(cart) for cart in page))
+
+            after_id = page[-1]['id']
+            if not args.dry_run:
+                await redis.hset(SWEEP_CHECKPOINT_KEY, mapping={
+                    "after_id": after_id,
+                    "updated_before": updated_before,
+                    **results
+                })
+
+            processed = sum(results.values())
+            logger.info(
+                f"Корзин обработано: {processed} (до id {after_id}), "
+                f"{'архивировано' if args.mode == 'archive' else 'удалено'}: {results['swept']}, "
+                f"пропущено: {results['skipped']}, с ошибкой: {results['failed']}, "
+                f"{(processed - resumed) / (time.monotonic() - started):.1f} в секунду"
+            )
+    except StrapiError as e:
+        logger.error(f"{e}. Запустите команду ещё раз, чтобы продолжить с id {after_id}")
+        return
+
+    if not args.dry_run:
+        await redis.delete(SWEEP_CHECKPOINT_KEY)
+    logger.info(
+        f"Готово{' (пробный запуск)' if args.dry_run else ''}: "
+        f"{'архивировано' if args.mode == 'archive' else 'удалено'} {results['swept']}, "
+        f"пропущено {results['skipped']}, с ошибкой {results['failed']}"
+    )
+
+
+async def main():
+    env = Env()
+    env.read_env()
+
+    parser = argparse.ArgumentParser(description="Обслуживание данных магазина в Strapi")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = subparsers.add_parser(
+        'compact-carts',
+        help="слить повторяющиеся строки товаров в активных корзинах"
+    )
+    compact_parser.add_argument('--page-size', type=int, default=100)
+    compact_parser.set_defaults(handler=compact_carts)
+
+    dedupe_parser = subparsers.add_parser(
+        'dedupe-customers',
+        help="слить клиентов с одинаковым telegram_id в одну запись"
+    )
+    dedupe_parser.add_argument('--page-size', type=int, default=100)
+    dedupe_parser.set_defaults(handler=dedupe_customers)
+
+    images_parser = subparsers.add_parser(
+        'prepare-images',
+        help="пережать картинки товаров в локальный кэш бота (нужен Pillow)"
+    )
+    images_parser.add_argument('--strapi-url', default=env.str('STRAPI_URL', None))
+    images_parser.add_argument('--cache-dir', default=env.str('IMAGE_CACHE_DIR', IMAGE_CACHE_DIR))
+    images_parser.add_argument('--photo-size', type=int, default=env.int('PHOTO_SIZE', PHOTO_SIZE))
+    images_parser.add_argument('--quality', type=int, default=env.int('PHOTO_QUALITY', PHOTO_QUALITY))
+    images_parser.add_argument('--concurrency', type=int, default=4)
+    images_parser.add_argument('--force', action='store_true', help="пережать заново уже готовые")
+    images_parser.set_defaults(handler=prepare_images)
+
+    sweep_parser = subparsers.add_parser(
+        'sweep-carts',
+        help="архивировать или удалить активные корзины, брошенные без оплаты"
+    )
+    sweep_parser.add_argument('--older-than-days', type=int, default=30, help="сколько дней корзина не менялась")
+    sweep_parser.add_argument(
+        '--mode',
+        choices=('archive', 'delete'),
+        default='archive',
+        help=f"archive переводит корзину в статус {ABANDONED_STATUS}, delete удаляет её вместе со строками"
+    )
+    sweep_parser.add_argument('--page-size', type=int, default=100)
+    sweep_parser.add_argument('--concurrency', type=int, default=8, help="сколько корзин обрабатывать одновременно")
+    sweep_parser.add_argument('--dry-run', action='store_true', help="только посчитать, ничего не меняя")
+    sweep_parser.add_argument('--restart', action='store_true', help="начать заново, не продолжая прерванный запуск")
+    sweep_parser.set_defaults(handler=sweep_carts)
+
+    memory_parser = subparsers.add_parser(
+        'redis-memory',
+        help="показать, сколько памяти Redis занимают ключи каждого шаблона"
+    )
+    memory_parser.add_argument('--match', default='*', help="шаблон SCAN для отбора ключей")
+    memory_parser.add_argument('--batch-size', type=int, default=500)
+    memory_parser.add_argument('--top', type=int, default=30, help="сколько шаблонов показать")
+    memory_parser.set_defaults(handler=redis_memory)
+
+    expire_parser = subparsers.add_parser(
+        'expire-persistent',
+        help="выставить TTL ключам без срока жизни с заданным началом шаблона (без --apply только посчитать)"
+    )
+    expire_parser.add_argument('prefix', help="начало шаблона ключей из отчёта redis-memory, например fsm:")
+    expire_parser.add_argument('--ttl', type=int, default=env.int('FSM_DATA_TTL', FSM_DATA_TTL))
+    expire_parser.add_argument('--match', default='*', help="шаблон SCAN для отбора ключей")
+    expire_parser.add_argument('--batch-size', type=int, default=500)
+    expire_parser.add_argument('--apply', action='store_true', help="выставить TTL, а не только посчитать ключи")
+    expire_parser.set_defaults(handler=expire_persistent)
+
+    args = parser.parse_args()
+
+    strapi = StrapiClient(env.str('STRAPI_BASE_URL'), env.str('STRAPI_TOKEN'))
+    redis_conn = Redis(
+        host=env.str("DATABASE_HOST", "localhost"),
+        port=env.int("DATABASE_PORT", 6379),
+        password=env.str("DATABASE_PASSWORD", None),
+        decode_responses=False
+    )
+    try:
+        await args.handler(strapi, redis_conn, args)
+    finally:
+        await strapi.close()
+        await redis_conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    logger.setLevel(logging.INFO)
+    asyncio.run(main())
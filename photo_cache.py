@@ -0,0 +1,86 @@
+import logging
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from catalog import Product
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PHOTO_CACHE_PREFIX = "photo_file_id"
+PHOTO_CACHE_TTL = 30 * 24 * 60 * 60
+
+photo_cache_counter = REGISTRY.counter(
+    "photo_cache_requests_total",
+    "Обращения к кэшу file_id фото товаров"
+)
+
+
+class PhotoCache:
+    """Хранит file_id загруженных в Telegram фото товаров.
+
+    Запись живёт по ключу documentId товара и помнит версию изображения,
+    с которой была загружена. Если в Strapi изображение поменялось,
+    версия не совпадёт и запись будет сброшена.
+    """
+
+    def __init__(self, redis: Redis, ttl: int = PHOTO_CACHE_TTL):
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(product_document_id: str) -> str:
+        return f"{PHOTO_CACHE_PREFIX}:{product_document_id}"
+
+    async def get(self, product: Product) -> Optional[str]:
+        if product.image is None:
+            return None
+        version = product.image.version
+
+        key = self._key(product.document_id)
+        cached = await self.redis.hgetall(key)
+        if not cached:
+            photo_cache_counter.inc(result="miss")
+            return None
+
+        cached_version = cached.get(b'version', b'').decode()
+        if cached_version != version:
+            logger.info(f"Изображение товара {product.document_id} изменилось, сбрасываем file_id")
+            await self.redis.delete(key)
+            photo_cache_counter.inc(result="stale")
+            return None
+
+        photo_cache_counter.inc(result="hit")
+        return cached[b'file_id'].decode()
+
+    async def cached(self, products: list[Product]) -> set[str]:
+        """documentId тех товаров, чьё текущее фото уже загружено в Telegram. Один запрос на всех."""
+        products = [product for product in products if product.image is not None]
+        if not products:
+            return set()
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for product in products:
+                pipe.hget(self._key(product.document_id), "version")
+            versions = await pipe.execute()
+
+        return {
+            product.document_id
+            for product, version in zip(products, versions)
+            if version is not None and version.decode() == product.image.version
+        }
+
+    async def set(self, product: Product, file_id: str):
+        if product.image is None:
+            return
+        version = product.image.version
+
+        key = self._key(product.document_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"version": version, "file_id": file_id})
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def invalidate(self, product: Product):
+        await self.redis.delete(self._key(product.document_id))
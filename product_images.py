@@ -0,0 +1,320 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from catalog import Catalog, Product, ProductImage
+from metrics import REGISTRY
+from photo_cache import PhotoCache
+from strapi_helpers import StrapiClient, get_media_url
+
+logger = logging.getLogger(__name__)
+
+# Telegram всё равно ужимает фото до 1280 пикселей по длинной стороне,
+# а в карточке товара хватает и меньшего
+PHOTO_SIZE = 800
+PHOTO_QUALITY = 85
+IMAGE_CACHE_DIR = "image_cache"
+IMAGE_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+PREFETCH_LIMIT = 30
+PREFETCH_CONCURRENCY = 4
+PREFETCH_COOLDOWN = 30
+PRODUCT_VIEWS_KEY = "product_views"
+
+image_source_counter = REGISTRY.counter(
+    "product_image_source_total",
+    "Откуда взяты байты картинки товара для отправки в Telegram"
+)
+image_memory_cache_gauge = REGISTRY.gauge(
+    "product_image_memory_cache_bytes",
+    "Сколько байт картинок товаров держится в памяти"
+)
+image_prefetch_counter = REGISTRY.counter(
+    "product_image_prefetch_total",
+    "Картинки товаров, скачанные заранее"
+)
+
+
+def transcode_image(data: bytes, max_size: int = PHOTO_SIZE, quality: int = PHOTO_QUALITY) -> bytes:
+    """Уменьшает картинку до max_size по длинной стороне и пережимает в JPEG.
+
+    Нужен Pillow. Он ставится отдельно и используется только при подготовке кэша.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+
+class TranscodedImageCache:
+    """Локальный кэш пережатых картинок с адресацией по содержимому.
+
+    Файл картинки называется по sha256 своих байтов и лежит в blobs/,
+    поэтому одинаковые картинки разных товаров хранятся один раз.
+    В refs/ по версии исходной картинки и параметрам пережатия лежит
+    ссылка на нужный blob: новая версия в Strapi даёт новую ссылку.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_size: int = PHOTO_SIZE, quality: int = PHOTO_QUALITY):
+        self.directory = directory
+        self.max_size = max_size
+        self.quality = quality
+
+    def _ref_path(self, image: ProductImage) -> str:
+        ref = hashlib.blake2b(
+            f"{image.version}:{self.max_size}:{self.quality}".encode(),
+            digest_size=16
+        ).hexdigest()
+        return os.path.join(self.directory, "refs", ref)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "blobs", f"{digest}.jpg")
+
+    def _read(self, image: ProductImage) -> Optional[bytes]:
+        try:
+            with open(self._ref_path(image)) as ref_file:
+                digest = ref_file.read().strip()
+            with open(self._blob_path(digest), 'rb') as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_atomic(path: str, payload: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as output_file:
+            output_file.write(payload)
+        os.replace(temporary_path, path)
+
+    def _write(self, image: ProductImage, data: bytes) -> bytes:
+        transcoded = transcode_image(data, self.max_size, self.quality)
+        digest = hashlib.sha256(transcoded).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            self._write_atomic(blob_path, transcoded)
+        self._write_atomic(self._ref_path(image), digest.encode())
+        return transcoded
+
+    def contains(self, image: ProductImage) -> bool:
+        return os.path.exists(self._ref_path(image))
+
+    async def get(self, image: ProductImage) -> Optional[bytes]:
+        try:
+            return await asyncio.to_thread(self._read, image)
+        except OSError as e:
+            logger.error(f"Не удалось прочитать картинку из кэша: {e}")
+            return None
+
+    async def put(self, image: ProductImage, data: bytes) -> bytes:
+        """Пережимает исходные байты и сохраняет результат. Пережатие идёт в отдельном потоке."""
+        return await asyncio.to_thread(self._write, image, data)
+
+
+class ImageByteCache:
+    """LRU-кэш байтов картинок в памяти с ограничением по суммарному размеру."""
+
+    def __init__(self, max_bytes: int = IMAGE_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        image_memory_cache_gauge.set_function(lambda: self.size)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        previous = self._items.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+
+        self._items[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class ProductViews:
+    """Сколько раз открывали каждый товар. Общий счётчик всех воркеров в Redis."""
+
+    def __init__(self, redis: Redis, key: str = PRODUCT_VIEWS_KEY):
+        self.redis = redis
+        self.key = key
+
+    async def record(self, product: Product):
+        try:
+            await self.redis.zincrby(self.key, 1, product.document_id)
+        except RedisError as e:
+            logger.warning(f"Не удалось учесть просмотр товара: {e}")
+
+    async def top(self, limit: int) -> list[str]:
+        try:
+            document_ids = await self.redis.zrevrange(self.key, 0, limit - 1)
+        except RedisError as e:
+            logger.warning(f"Не удалось получить популярные товары: {e}")
+            return []
+        return [document_id.decode() for document_id in document_ids]
+
+
+def image_key(product: Product) -> str:
+    return f"{product.document_id}:{product.image.version}"
+
+
+class ProductImages:
+    """Байты картинки товара для отправки в Telegram.
+
+    Порядок поиска: кэш в памяти, заранее пережатая копия на диске, Strapi
+    (самая лёгкая копия, которая не меньше photo_size). Одновременные
+    запросы одной картинки превращаются в одно скачивание.
+
+    Пока пользователь смотрит меню, schedule_prefetch в фоне скачивает
+    картинки самых просматриваемых товаров, у которых ещё нет file_id
+    в Telegram, чтобы нажатие на товар не ждало Strapi.
+    """
+
+    def __init__(
+            self,
+            strapi: StrapiClient,
+            photo_size: int = PHOTO_SIZE,
+            transcoded: Optional[TranscodedImageCache] = None,
+            memory_cache: Optional[ImageByteCache] = None,
+            views: Optional[ProductViews] = None,
+            photo_cache: Optional[PhotoCache] = None,
+            prefetch_limit: int = PREFETCH_LIMIT,
+            prefetch_concurrency: int = PREFETCH_CONCURRENCY,
+            prefetch_cooldown: float = PREFETCH_COOLDOWN
+    ):
+        self.strapi = strapi
+        self.photo_size = photo_size
+        self.transcoded = transcoded
+        self.memory_cache = memory_cache
+        self.views = views
+        self.photo_cache = photo_cache
+        self.prefetch_limit = prefetch_limit
+        self.prefetch_concurrency = prefetch_concurrency
+        self.prefetch_cooldown = prefetch_cooldown
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._prefetch_task: Optional[asyncio.Task] = None
+        self._prefetch_started = 0.0
+
+    def url_for(self, image: ProductImage) -> str:
+        return get_media_url(image.pick_url(self.photo_size), self.strapi.strapi_base_url)
+
+    async def _load(self, product: Product) -> Optional[bytes]:
+        data = None
+        if self.transcoded is not None:
+            data = await self.transcoded.get(product.image)
+            if data:
+                image_source_counter.inc(source="transcoded")
+
+        if not data:
+            image_source_counter.inc(source="strapi")
+            data = await self.strapi.download_image(self.url_for(product.image))
+
+        if data and self.memory_cache is not None:
+            self.memory_cache.put(image_key(product), data)
+        return data
+
+    async def fetch(self, product: Product) -> Optional[bytes]:
+        if product.image is None:
+            return None
+
+        key = image_key(product)
+        if self.memory_cache is not None:
+            data = self.memory_cache.get(key)
+            if data is not None:
+                image_source_counter.inc(source="memory")
+                return data
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(product))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def record_view(self, product: Product):
+        if self.views is not None:
+            await self.views.record(product)
+
+    async def _prefetch_candidates(self, catalog: Catalog) -> list[Product]:
+        popular = await self.views.top(self.prefetch_limit) if self.views is not None else []
+        ordered = [catalog.get_by_document_id(document_id) for document_id in popular]
+        ordered.extend(catalog.products)
+
+        candidates = []
+        seen = set()
+        for product in ordered:
+            if product is None or product.image is None or product.document_id in seen:
+                continue
+            seen.add(product.document_id)
+            if self.memory_cache is not None and image_key(product) in self.memory_cache:
+                continue
+            candidates.append(product)
+            if len(candidates) >= self.prefetch_limit:
+                break
+
+        if self.photo_cache is not None and candidates:
+            # Для товаров с file_id бот отправит фото без скачивания
+            uploaded = await self.photo_cache.cached(candidates)
+            candidates = [product for product in candidates if product.document_id not in uploaded]
+        return candidates
+
+    async def prefetch(self, catalog: Catalog):
+        candidates = await self._prefetch_candidates(catalog)
+        semaphore = asyncio.Semaphore(self.prefetch_concurrency)
+
+        async def prefetch_one(product: Product):
+            async with semaphore:
+                if await self.fetch(product):
+                    image_prefetch_counter.inc()
+
+        await asyncio.gather(*(prefetch_one(product) for product in candidates))
+
+    def schedule_prefetch(self, catalog: Catalog):
+        """Запускает prefetch в фоне, если он не идёт и не запускался последние prefetch_cooldown секунд."""
+        if self.memory_cache is None or not self.prefetch_limit:
+            return
+        if self._prefetch_task is not None and not self._prefetch_task.done():
+            return
+        now = time.monotonic()
+        if now - self._prefetch_started < self.prefetch_cooldown:
+            return
+
+        self._prefetch_started = now
+        self._prefetch_task = asyncio.create_task(self.prefetch(catalog))
+        self._prefetch_task.add_done_callback(self._log_prefetch_error)
+
+    @staticmethod
+    def _log_prefetch_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка при предзагрузке картинок: {task.exception()!r}")
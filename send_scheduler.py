@@ -0,0 +1,245 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage,
+    EditMessageCaption,
+    EditMessageMedia,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    ForwardMessage,
+    Response,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    TelegramMethod
+)
+from aiogram.methods.base import TelegramType
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+MAX_RETRIES = 3
+IDLE_BUCKET_TTL = 60
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Методы, на которые действуют лимиты Telegram на отправку сообщений.
+# answerCallbackQuery, deleteMessage и служебные вызовы идут без очереди.
+RATE_LIMITED_METHODS = (
+    SendMessage,
+    SendPhoto,
+    SendMediaGroup,
+    CopyMessage,
+    ForwardMessage,
+    EditMessageText,
+    EditMessageMedia,
+    EditMessageCaption,
+    EditMessageReplyMarkup,
+)
+
+send_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+queue_depth_gauge = REGISTRY.gauge(
+    "telegram_send_queue_depth",
+    "Сколько запросов к Telegram ждут своей очереди"
+)
+queue_wait_histogram = REGISTRY.histogram(
+    "telegram_send_queue_wait_seconds",
+    "Время ожидания запроса к Telegram в очереди отправки"
+)
+retry_after_counter = REGISTRY.counter(
+    "telegram_retry_after_total",
+    "Ответы 429 от Telegram, пересланные повторно"
+)
+
+
+@contextmanager
+def bulk_priority():
+    """Отправки внутри блока пропускают вперёд ответы на действия пользователей."""
+    token = send_priority.set(PRIORITY_BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Очередь исходящих запросов к Telegram с учётом лимитов.
+
+    Подключается к сессии бота и пропускает отправку и редактирование
+    сообщений через два ведра токенов: общее на бота (~30 в секунду)
+    и отдельное на каждый чат (~1 в секунду). Ждущие запросы выходят
+    по приоритету: ответы пользователям раньше массовых рассылок.
+    На 429 чат блокируется на retry_after и запрос повторяется.
+    """
+
+    def __init__(
+            self,
+            global_rate: float = GLOBAL_RATE,
+            chat_rate: float = CHAT_RATE,
+            chat_burst: float = CHAT_BURST,
+            max_retries: int = MAX_RETRIES
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._waiters: list[tuple] = []
+        self._sequence = itertools.count()
+        self._wake = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        queue_depth_gauge.set_function(lambda: len(self._waiters))
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(self.max_retries + 1):
+            with span("telegram.queue"):
+                await self.acquire(chat_id, send_priority.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after_counter.inc(method=type(method).__name__)
+                logger.warning(f"Telegram просит подождать {e.retry_after} с, чат {chat_id}")
+                self._bucket_for(chat_id).block(e.retry_after)
+
+    def _bucket_for(self, chat_id) -> TokenBucket:
+        if chat_id is None:
+            return self.global_bucket
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id, priority: int = PRIORITY_INTERACTIVE):
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        bisect.insort(self._waiters, (priority, next(self._sequence), chat_id, future))
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wake.set()
+
+        await future
+        queue_wait_histogram.observe(time.monotonic() - enqueued_at)
+
+    def _grant_next(self, now: float) -> Optional[float]:
+        """Выпускает первый ждущий запрос, чей чат не упёрся в лимит.
+
+        Возвращает, сколько ждать до следующей попытки, или None, если выпустили.
+        """
+        global_delay = self.global_bucket.delay(now)
+        if global_delay > 0:
+            return global_delay
+
+        next_delay = None
+        for index, (_, _, chat_id, future) in enumerate(self._waiters):
+            if future.done():
+                continue
+            chat_delay = self._bucket_for(chat_id).delay(now) if chat_id is not None else 0.0
+            if chat_delay == 0:
+                del self._waiters[index]
+                self.global_bucket.take(now)
+                if chat_id is not None:
+                    self._chat_buckets[chat_id].take(now)
+                future.set_result(None)
+                return None
+            next_delay = chat_delay if next_delay is None else min(next_delay, chat_delay)
+
+        return next_delay
+
+    def _prune(self, now: float):
+        self._waiters = [waiter for waiter in self._waiters if not waiter[3].done()]
+        waiting_chats = {waiter[2] for waiter in self._waiters}
+        for chat_id in list(self._chat_buckets):
+            bucket = self._chat_buckets[chat_id]
+            if chat_id not in waiting_chats and bucket.is_idle(now):
+                del self._chat_buckets[chat_id]
+
+    async def _dispatch(self):
+        last_prune = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - last_prune > IDLE_BUCKET_TTL:
+                self._prune(now)
+                last_prune = now
+
+            if not self._waiters:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            delay = self._grant_next(now)
+            if delay is None:
+                continue
+            if not any(not waiter[3].done() for waiter in self._waiters):
+                self._waiters.clear()
+                continue
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
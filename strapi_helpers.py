@@ -1,308 +1,790 @@
+import asyncio
 import logging
-from typing import Optional
+import random
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
 
-import requests
+import aiohttp
+
+from metrics import REGISTRY
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
 REQUEST_TIMEOUT = 10
+CONNECTION_LIMIT = 100
+PRODUCTS_PAGE_SIZE = 100
+PAGE_FETCH_CONCURRENCY = 4
+
+OPERATION_TIMEOUTS = {
+    "products": 10,
+    "image": 10,
+    "cart_read": 3,
+    "cart_write": 5,
+    "customer": 5,
+}
+READ_RETRIES = 2
+RETRY_BASE_DELAY = 0.2
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+STALE_CACHE_SIZE = 10000
+
+# Только те поля, что читает бот: без populate=* ответы Strapi в разы меньше
+PRODUCT_FIELDS = ("title", "price", "description", "updatedAt")
+PRODUCT_IMAGE_FIELDS = ("url", "hash", "updatedAt", "formats")
+CART_ITEM_FIELDS = ("quantity",)
+CART_PRODUCT_FIELDS = ("title", "price")
+
+breaker_state_gauge = REGISTRY.gauge(
+    "strapi_circuit_open",
+    "1, если предохранитель запросов к Strapi разомкнут"
+)
+retry_counter = REGISTRY.counter(
+    "strapi_retries_total",
+    "Повторные попытки читающих запросов к Strapi"
+)
+stale_counter = REGISTRY.counter(
+    "strapi_stale_responses_total",
+    "Ответы Strapi, отданные из последнего удачного снимка"
+)
+request_duration_histogram = REGISTRY.histogram(
+    "strapi_request_duration_seconds",
+    "Длительность одной попытки запроса к Strapi по видам операций"
+)
+request_error_counter = REGISTRY.counter(
+    "strapi_request_errors_total",
+    "Запросы к Strapi, завершившиеся ошибкой"
+)
+
+
+class StrapiError(Exception):
+    pass
+
+
+class StrapiRejectedError(StrapiError):
+    """Strapi отклонил запрос с 400 или 404: связанная запись не найдена или данные неверны."""
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    """Strapi считается недоступным, запрос не отправлялся.
+
+    Наследуется от ClientError, чтобы его ловили те же обработчики,
+    что и обычные сетевые ошибки.
+    """
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд и reset_timeout секунд
+    отклоняет запросы сразу. Затем пропускает один пробный запрос:
+    успех замыкает цепь, ошибка размыкает её снова."""
+
+    def __init__(
+            self,
+            failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+            reset_timeout: float = BREAKER_RESET_TIMEOUT
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_started: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow_request(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        # Пробный запрос, который так и не завершился, не должен держать цепь вечно
+        if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+            return False
+        if now - self.opened_at >= self.reset_timeout:
+            self._trial_started = now
+            return True
+        return False
 
-
-def get_products(strapi_url: str, strapi_token: str) -> Optional[dict]:
-    headers = {"Authorization": f"Bearer {strapi_token}"}
-    params = {"populate": "*"}
-
-    try:
-        response = requests.get(
-            strapi_url,
-            headers=headers,
-            params=params,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при получении продуктов: {e}")
-        return None
-
-
-def get_image_url(product: dict, strapi_base_url: str) -> Optional[str]:
-    try:
-        if 'image' not in product:
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Strapi снова отвечает, предохранитель замкнут")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+        breaker_state_gauge.set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error("Strapi недоступен, предохранитель разомкнут")
+            self.opened_at = time.monotonic()
+            self._trial_started = None
+            breaker_state_gauge.set(1)
+
+
+def is_server_failure(error: Exception) -> bool:
+    """Ошибки 4xx говорят о плохом запросе, а не о недоступности Strapi."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+class StrapiClient:
+    """Асинхронный клиент Strapi с общим пулом keep-alive соединений."""
+
+    def __init__(
+            self,
+            strapi_base_url: str,
+            strapi_token: str,
+            connection_limit: int = CONNECTION_LIMIT,
+            request_timeout: float = REQUEST_TIMEOUT,
+            timeouts: Optional[dict] = None,
+            read_retries: int = READ_RETRIES,
+            breaker: Optional[CircuitBreaker] = None
+    ):
+        self.strapi_base_url = strapi_base_url.rstrip('/')
+        self.strapi_token = strapi_token
+        self.connection_limit = connection_limit
+        self.request_timeout = request_timeout
+        self.timeouts = {**OPERATION_TIMEOUTS, **(timeouts or {})}
+        self.read_retries = read_retries
+        self.breaker = breaker or CircuitBreaker()
+        self._stale: OrderedDict[tuple, dict] = OrderedDict()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._auth_headers = {"Authorization": f"Bearer {strapi_token}"}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=30
+            )
+            # Токен не ставится на всю сессию: картинки могут лежать на стороннем CDN
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _timeout(self, operation: str) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=self.timeouts.get(operation, self.request_timeout))
+
+    def _remember(self, cache_key: tuple, payload: dict):
+        self._stale[cache_key] = payload
+        self._stale.move_to_end(cache_key)
+        if len(self._stale) > STALE_CACHE_SIZE:
+            self._stale.popitem(last=False)
+
+    def _serve_stale(self, cache_key: Optional[tuple], operation: str) -> Optional[dict]:
+        if cache_key is None or cache_key not in self._stale:
             return None
-
-        image_field = product['image']
-
-        if isinstance(image_field, dict) and 'data' in image_field:
-            url = image_field['data']['attributes']['url']
-        elif isinstance(image_field, dict) and 'url' in image_field:
-            url = image_field['url']
-        else:
+        stale_counter.inc(operation=operation)
+        return self._stale[cache_key]
+
+    async def _request(
+            self,
+            method: str,
+            url: str,
+            params: Optional[dict] = None,
+            json: Optional[dict] = None,
+            operation: str = "default",
+            stale_ok: bool = False,
+            helper: str = "unknown"
+    ) -> Optional[dict]:
+        """Запрос к Strapi с таймаутом операции, повторами и предохранителем.
+
+        Читающие запросы повторяются с задержкой со случайным разбросом.
+        Если stale_ok, удачный ответ запоминается и отдаётся повторно,
+        когда Strapi не отвечает или предохранитель разомкнут.
+        """
+        cache_key = (url, tuple(sorted((params or {}).items()))) if stale_ok else None
+
+        if not self.breaker.allow_request():
+            stale = self._serve_stale(cache_key, operation)
+            if stale is not None:
+                return stale
+            raise CircuitOpenError(f"Strapi недоступен, запрос {method} {url} не отправлен")
+
+        attempts = 1 + (self.read_retries if method == "GET" else 0)
+        for attempt in range(attempts):
+            try:
+                with (
+                    request_duration_histogram.time(operation=operation, helper=helper, method=method),
+                    span(f"strapi.{helper}")
+                ):
+                    async with self.session.request(
+                            method,
+                            url,
+                            params=params,
+                            json=json,
+                            headers=self._auth_headers,
+                            timeout=self._timeout(operation)
+                    ) as response:
+                        response.raise_for_status()
+                        payload = {} if response.status == 204 else await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                request_error_counter.inc(operation=operation, helper=helper, error=type(e).__name__)
+                if not is_server_failure(e):
+                    self.breaker.record_success()
+                    raise
+
+                self.breaker.record_failure()
+                if attempt + 1 < attempts and self.breaker.allow_request():
+                    retry_counter.inc(operation=operation)
+                    await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+                    continue
+
+                stale = self._serve_stale(cache_key, operation)
+                if stale is not None:
+                    logger.warning(f"Strapi не ответил ({e}), отдаём последний удачный ответ")
+                    return stale
+                raise
+
+            self.breaker.record_success()
+            if cache_key is not None:
+                self._remember(cache_key, payload)
+            return payload
+
+    async def get_products(
+            self,
+            strapi_url: str,
+            updated_after: Optional[str] = None,
+            page: int = 1,
+            page_size: int = PRODUCTS_PAGE_SIZE
+    ) -> Optional[dict]:
+        params = {
+            **select_fields("fields", PRODUCT_FIELDS),
+            **select_fields("populate[image][fields]", PRODUCT_IMAGE_FIELDS),
+            "sort[0]": "id:asc",
+            "pagination[page]": page,
+            "pagination[pageSize]": page_size
+        }
+        if updated_after:
+            params["filters[updatedAt][$gt]"] = updated_after
+
+        try:
+            return await self._request(
+                "GET",
+                strapi_url,
+                params=params,
+                operation="products",
+                helper="get_products"
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при получении продуктов: {e}")
             return None
 
-        if url.startswith('/'):
-            return f"{strapi_base_url}{url}"
-        return url
-    except (KeyError, TypeError) as e:
-        logger.error(f"Ошибка при извлечении URL изображения: {e}")
-        return None
+    async def iter_product_pages(
+            self,
+            strapi_url: str,
+            updated_after: Optional[str] = None,
+            page_size: int = PRODUCTS_PAGE_SIZE,
+            concurrency: int = PAGE_FETCH_CONCURRENCY
+    ) -> AsyncIterator[list]:
+        """Отдаёт товары постранично, следуя meta.pagination.
+
+        Первая страница сообщает общее число страниц, остальные
+        запрашиваются окнами не больше concurrency запросов за раз
+        и отдаются по порядку. Если страница не загрузилась,
+        выбрасывается StrapiError: неполный каталог хуже старого.
+        """
+        first_page = await self.get_products(strapi_url, updated_after, 1, page_size)
+        if not first_page or 'data' not in first_page:
+            raise StrapiError("Не удалось загрузить первую страницу товаров")
+
+        yield first_page['data']
+
+        pagination = first_page.get('meta', {}).get('pagination', {})
+        page_count = pagination.get('pageCount', 1)
+
+        for window_start in range(2, page_count + 1, concurrency):
+            window = range(window_start, min(window_start + concurrency, page_count + 1))
+            pages = await asyncio.gather(*(
+                self.get_products(strapi_url, updated_after, page, page_size)
+                for page in window
+            ))
+            for page_number, page in zip(window, pages):
+                if not page or 'data' not in page:
+                    raise StrapiError(f"Не удалось загрузить страницу товаров {page_number}")
+                yield page['data']
+
+    async def download_image(self, image_url: str) -> Optional[bytes]:
+        try:
+            with (
+                request_duration_histogram.time(operation="image", helper="download_image", method="GET"),
+                span("strapi.download_image")
+            ):
+                async with self.session.get(image_url, timeout=self._timeout("image")) as response:
+                    response.raise_for_status()
+                    return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            request_error_counter.inc(operation="image", helper="download_image", error=type(e).__name__)
+            logger.error(f"Ошибка при скачивании изображения: {e}")
+            return None
 
+    async def create_cart(self, telegram_id: int) -> Optional[dict]:
+        carts_url = f"{self.strapi_base_url}/api/carts"
 
-def download_image(image_url: str) -> Optional[bytes]:
-    try:
-        response = requests.get(image_url, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        return response.content
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при скачивании изображения: {e}")
-        return None
+        try:
+            cart_payload = {
+                "data": {
+                    "telegram_id": str(telegram_id),
+                    "order_status": "active"
+                }
+            }
+            cart_response = await self._request(
+                "POST",
+                carts_url,
+                json=cart_payload,
+                operation="cart_write",
+                helper="create_cart"
+            )
+            logger.info(f"Создана новая корзина для telegram_id: {telegram_id}")
+            return cart_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при создании корзины: {e}")
+            return None
 
+    async def add_product_to_cart(
+            self,
+            cart_document_id: str,
+            product_document_id: str,
+            quantity: float = 1.0
+    ) -> Optional[dict]:
+        cart_items_url = f"{self.strapi_base_url}/api/cart-items"
+
+        try:
+            cart_item_payload = {
+                "data": {
+                    "quantity": quantity,
+                    "cart": cart_document_id,
+                    "product": product_document_id
+                }
+            }
+            cart_item_response = await self._request(
+                "POST",
+                cart_items_url,
+                json=cart_item_payload,
+                operation="cart_write",
+                helper="add_product_to_cart"
+            )
+            return cart_item_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при добавлении товара в корзину: {e}")
+            return None
 
-def get_cart(
-        strapi_base_url: str,
-        strapi_token: str,
-        telegram_id: int
-) -> Optional[dict]:
-    headers = {
-        "Authorization": f"Bearer {strapi_token}",
-        "Content-Type": "application/json"
-    }
-    carts_url = f"{strapi_base_url}/api/carts"
+    async def update_cart_item_quantity(
+            self,
+            cart_item_document_id: str,
+            quantity: float
+    ) -> Optional[dict]:
+        cart_item_url = f"{self.strapi_base_url}/api/cart-items/{cart_item_document_id}"
+
+        try:
+            cart_item_payload = {"data": {"quantity": quantity}}
+            cart_item_response = await self._request(
+                "PUT",
+                cart_item_url,
+                json=cart_item_payload,
+                operation="cart_write",
+                helper="update_cart_item_quantity"
+            )
+            return cart_item_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при изменении количества товара в корзине: {e}")
+            return None
 
-    try:
-        params = {
-            "filters[telegram_id][$eq]": telegram_id,
-            "filters[order_status][$eq]": "active",
-            "populate": "*"
-        }
-        response = requests.get(
-            carts_url,
-            headers=headers,
-            params=params,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        cart_response = response.json()
-
-        if cart_response.get('data'):
-            return cart_response['data'][0]
+    async def fetch_cart_with_items(
+            self,
+            telegram_id: int,
+            stale_ok: bool = False
+    ) -> Optional[dict]:
+        """Как get_cart_with_items, но ошибка запроса выбрасывается как StrapiError.
+
+        Нужно там, где отсутствие корзины и недоступность Strapi надо различать.
+        """
+        carts_url = f"{self.strapi_base_url}/api/carts"
+
+        try:
+            params = {
+                "filters[telegram_id][$eq]": telegram_id,
+                "filters[order_status][$eq]": "active",
+                "fields[0]": "order_status",
+                **cart_items_params()
+            }
+            carts_response = await self._request(
+                "GET",
+                carts_url,
+                params=params,
+                operation="cart_read",
+                helper="fetch_cart_with_items",
+                stale_ok=stale_ok
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise StrapiError(f"Ошибка при получении корзины: {e}") from e
 
-        return None
+        if carts_response.get('data'):
+            warn_if_several_active_carts(carts_response['data'], telegram_id)
+            return carts_response['data'][0]
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при получении корзины: {e}")
         return None
 
+    async def get_cart_with_items(
+            self,
+            telegram_id: int,
+            stale_ok: bool = False
+    ) -> Optional[dict]:
+        """stale_ok разрешает показать последнюю удачно прочитанную корзину,
+        пока Strapi недоступен. Годится для просмотра, но не для изменений."""
+        try:
+            return await self.fetch_cart_with_items(telegram_id, stale_ok=stale_ok)
+        except StrapiError as e:
+            logger.error(e)
+            return None
 
-def create_cart(
-        strapi_base_url: str,
-        strapi_token: str,
-        telegram_id: int
-) -> Optional[dict]:
-    headers = {
-        "Authorization": f"Bearer {strapi_token}",
-        "Content-Type": "application/json"
-    }
-    carts_url = f"{strapi_base_url}/api/carts"
-
-    try:
-        cart_payload = {
-            "data": {
-                "telegram_id": str(telegram_id),
-                "order_status": "active"
+    async def get_active_carts(
+            self,
+            page: int = 1,
+            page_size: int = PRODUCTS_PAGE_SIZE
+    ) -> Optional[dict]:
+        carts_url = f"{self.strapi_base_url}/api/carts"
+
+        try:
+            params = {
+                "filters[order_status][$eq]": "active",
+                **select_fields("fields", ("telegram_id", "order_status", "updatedAt")),
+                **cart_items_params(),
+                "sort[0]": "id:asc",
+                "pagination[page]": page,
+                "pagination[pageSize]": page_size
             }
-        }
-        response = requests.post(
-            carts_url,
-            headers=headers,
-            json=cart_payload,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        logger.info(f"Создана новая корзина для telegram_id: {telegram_id}")
-        return response.json()['data']
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при создании корзины: {e}")
-        return None
-
+            return await self._request(
+                "GET",
+                carts_url,
+                params=params,
+                operation="cart_read",
+                helper="get_active_carts"
+            )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при получении активных корзин: {e}")
+            return None
 
-def add_product_to_cart(
-        strapi_base_url: str,
-        strapi_token: str,
-        cart_document_id: str,
-        product_document_id: str,
-        quantity: float = 1.0
-) -> Optional[dict]:
-    headers = {
-        "Authorization": f"Bearer {strapi_token}",
-        "Content-Type": "application/json"
-    }
-    cart_items_url = f"{strapi_base_url}/api/cart-items"
-
-    try:
-        cart_item_payload = {
-            "data": {
-                "quantity": quantity,
-                "cart": cart_document_id,
-                "product": product_document_id
+    async def get_stale_carts(
+            self,
+            updated_before: str,
+            after_id: int = 0,
+            page_size: int = PRODUCTS_PAGE_SIZE
+    ) -> Optional[dict]:
+        """Активные корзины, не менявшиеся с updated_before, с id больше after_id.
+
+        Страницы выбираются по id, а не по номеру: заархивированные
+        и удалённые корзины выпадают из выборки и не сдвигают следующие.
+        """
+        carts_url = f"{self.strapi_base_url}/api/carts"
+
+        try:
+            params = {
+                "filters[order_status][$eq]": "active",
+                "filters[updatedAt][$lt]": updated_before,
+                "filters[id][$gt]": after_id,
+                **select_fields("fields", ("telegram_id", "updatedAt")),
+                **select_fields("populate[items][fields]", ("updatedAt",)),
+                "sort[0]": "id:asc",
+                "pagination[page]": 1,
+                "pagination[pageSize]": page_size,
+                "pagination[withCount]": "false"
             }
-        }
-        response = requests.post(
-            cart_items_url,
-            headers=headers,
-            json=cart_item_payload,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        return response.json()['data']
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при добавлении товара в корзину: {e}")
-        return None
+            return await self._request(
+                "GET",
+                carts_url,
+                params=params,
+                operation="cart_read",
+                helper="get_stale_carts"
+            )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при получении заброшенных корзин: {e}")
+            return None
 
+    async def iter_stale_cart_pages(
+            self,
+            updated_before: str,
+            after_id: int = 0,
+            page_size: int = PRODUCTS_PAGE_SIZE
+    ) -> AsyncIterator[list]:
+        """Отдаёт заброшенные корзины постранично, пока они не кончатся.
+
+        Следующая страница запрашивается после того, как вызывающий код
+        обработал текущую. Конец — только пустая страница: Strapi урезает
+        pageSize до своего maxLimit, и короткая страница ещё не значит,
+        что корзин больше нет. Если страница не загрузилась, выбрасывается StrapiError.
+        """
+        while True:
+            carts_response = await self.get_stale_carts(updated_before, after_id, page_size)
+            if not carts_response or 'data' not in carts_response:
+                raise StrapiError(f"Не удалось загрузить корзины после id {after_id}")
+
+            carts = carts_response['data']
+            if not carts:
+                return
+            yield carts
+            after_id = carts[-1]['id']
+
+    async def set_cart_status(self, cart_document_id: str, order_status: str) -> Optional[dict]:
+        cart_url = f"{self.strapi_base_url}/api/carts/{cart_document_id}"
+
+        try:
+            cart_response = await self._request(
+                "PUT",
+                cart_url,
+                json={"data": {"order_status": order_status}},
+                operation="cart_write",
+                helper="set_cart_status"
+            )
+            return cart_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при смене статуса корзины: {e}")
+            return None
 
-def get_cart_with_items(
-        strapi_base_url: str,
-        strapi_token: str,
-        telegram_id: int
-) -> Optional[dict]:
-    headers = {"Authorization": f"Bearer {strapi_token}"}
-    carts_url = f"{strapi_base_url}/api/carts"
+    async def delete_cart(self, cart_document_id: str) -> bool:
+        cart_url = f"{self.strapi_base_url}/api/carts/{cart_document_id}"
+
+        try:
+            await self._request("DELETE", cart_url, operation="cart_write", helper="delete_cart")
+            return True
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при удалении корзины: {e}")
+            return False
+
+    async def remove_cart_item(self, cart_item_document_id: str) -> bool:
+        cart_item_url = f"{self.strapi_base_url}/api/cart-items/{cart_item_document_id}"
+
+        try:
+            await self._request("DELETE", cart_item_url, operation="cart_write", helper="remove_cart_item")
+            return True
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при удалении товара из корзины: {e}")
+            return False
+
+    async def create_customer(
+            self,
+            telegram_id: int,
+            email: str,
+            username: Optional[str] = None
+    ) -> Optional[dict]:
+        customers_url = f"{self.strapi_base_url}/api/customers"
+
+        try:
+            customer_payload = {
+                "data": {
+                    "telegram_id": str(telegram_id),
+                    "email": email,
+                    "username": username
+                }
+            }
+            customer_response = await self._request(
+                "POST",
+                customers_url,
+                json=customer_payload,
+                operation="customer",
+                helper="create_customer"
+            )
+            logger.info(f"Клиент создан для telegram_id: {telegram_id}")
+            return customer_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при создании клиента: {e}")
+            return None
 
-    try:
-        params = {
-            "filters[telegram_id][$eq]": telegram_id,
-            "filters[order_status][$eq]": "active",
-            "populate[items][populate][0]": "product"
-        }
-        response = requests.get(
-            carts_url,
-            headers=headers,
-            params=params,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        carts_response = response.json()
+    async def fetch_customer(self, telegram_id: int) -> Optional[dict]:
+        """Самый ранний клиент с этим telegram_id; ошибка запроса выбрасывается как StrapiError."""
+        customers_url = f"{self.strapi_base_url}/api/customers"
 
-        if carts_response.get('data'):
-            return carts_response['data'][0]
+        try:
+            params = {
+                "filters[telegram_id][$eq]": telegram_id,
+                "sort[0]": "id:asc"
+            }
+            customer_payload = await self._request(
+                "GET",
+                customers_url,
+                params=params,
+                operation="customer",
+                helper="fetch_customer"
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise StrapiError(f"Ошибка при получении клиента: {e}") from e
 
-        return None
+        if customer_payload.get('data'):
+            return customer_payload['data'][0]
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при получении корзины: {e}")
         return None
 
+    async def update_customer(
+            self,
+            customer_document_id: str,
+            email: str,
+            username: Optional[str] = None
+    ) -> Optional[dict]:
+        customer_url = f"{self.strapi_base_url}/api/customers/{customer_document_id}"
+
+        try:
+            customer_payload = {"data": {"email": email, "username": username}}
+            customer_response = await self._request(
+                "PUT",
+                customer_url,
+                json=customer_payload,
+                operation="customer",
+                helper="update_customer"
+            )
+            return customer_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при обновлении клиента: {e}")
+            return None
 
-def remove_cart_item(
-        strapi_base_url: str,
-        strapi_token: str,
-        cart_item_document_id: str
-) -> bool:
-    headers = {"Authorization": f"Bearer {strapi_token}"}
-    cart_item_url = f"{strapi_base_url}/api/cart-items/{cart_item_document_id}"
+    async def get_customers(
+            self,
+            page: int = 1,
+            page_size: int = PRODUCTS_PAGE_SIZE
+    ) -> Optional[dict]:
+        customers_url = f"{self.strapi_base_url}/api/customers"
+
+        try:
+            params = {
+                "fields[0]": "telegram_id",
+                "fields[1]": "email",
+                "fields[2]": "username",
+                "populate[carts][fields][0]": "documentId",
+                "sort[0]": "id:asc",
+                "pagination[page]": page,
+                "pagination[pageSize]": page_size
+            }
+            return await self._request(
+                "GET",
+                customers_url,
+                params=params,
+                operation="customer",
+                helper="get_customers"
+            )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при получении клиентов: {e}")
+            return None
 
-    try:
-        response = requests.delete(cart_item_url, headers=headers, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        return True
+    async def delete_customer(self, customer_document_id: str) -> bool:
+        customer_url = f"{self.strapi_base_url}/api/customers/{customer_document_id}"
+
+        try:
+            await self._request("DELETE", customer_url, operation="customer", helper="delete_customer")
+            return True
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при удалении клиента: {e}")
+            return False
+
+    async def set_cart_customer(
+            self,
+            cart_document_id: str,
+            customer_document_id: str
+    ) -> Optional[dict]:
+        cart_url = f"{self.strapi_base_url}/api/carts/{cart_document_id}"
+
+        try:
+            cart_payload = {"data": {"customer": customer_document_id}}
+            cart_response = await self._request(
+                "PUT",
+                cart_url,
+                json=cart_payload,
+                operation="cart_write",
+                helper="set_cart_customer"
+            )
+            return cart_response['data']
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при переносе корзины к клиенту: {e}")
+            return None
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при удалении товара из корзины: {e}")
-        return False
+    async def link_cart_to_customer_and_complete(
+            self,
+            cart_document_id: str,
+            customer_document_id: str
+    ) -> Optional[dict]:
+        cart_url = f"{self.strapi_base_url}/api/carts/{cart_document_id}"
+
+        try:
+            cart_payload = {
+                "data": {
+                    "customer": customer_document_id,
+                    "order_status": "completed"
+                }
+            }
+            cart_response = await self._request(
+                "PUT",
+                cart_url,
+                json=cart_payload,
+                operation="cart_write",
+                helper="link_cart_to_customer_and_complete"
+            )
+            logger.info(f"Заказ оформлен для корзины {cart_document_id}")
+            return cart_response['data']
+
+        except aiohttp.ClientResponseError as e:
+            if e.status in (400, 404):
+                raise StrapiRejectedError(
+                    f"Strapi отклонил оформление корзины {cart_document_id} "
+                    f"для клиента {customer_document_id}: {e.status}"
+                ) from e
+            logger.error(f"Ошибка при обновлении корзины: {e}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при обновлении корзины: {e}")
+            return None
 
 
-def create_customer(
-        strapi_base_url: str,
-        strapi_token: str,
-        telegram_id: int,
-        email: str,
-        username: Optional[str] = None
-) -> Optional[dict]:
-    headers = {
-        "Authorization": f"Bearer {strapi_token}",
-        "Content-Type": "application/json"
-    }
-    customers_url = f"{strapi_base_url}/api/customers"
-
-    try:
-        customer_payload = {
-            "data": {
-                "telegram_id": str(telegram_id),
-                "email": email,
-                "username": username
-            }
-        }
-        response = requests.post(
-            customers_url,
-            headers=headers,
-            json=customer_payload,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        logger.info(f"Клиент создан для telegram_id: {telegram_id}")
-        return response.json()['data']
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при создании клиента: {e}")
-        return None
+def warn_if_several_active_carts(carts: list, telegram_id: int):
+    if len(carts) > 1:
+        cart_ids = ", ".join(cart['documentId'] for cart in carts)
+        logger.warning(f"У пользователя {telegram_id} несколько активных корзин: {cart_ids}")
 
 
-def get_customer(strapi_base_url: str, strapi_token: str, telegram_id: int) -> Optional[dict]:
-    headers = {"Authorization": f"Bearer {strapi_token}"}
-    customers_url = f"{strapi_base_url}/api/customers"
+def select_fields(prefix: str, fields: tuple) -> dict:
+    """Параметры вида fields[0]=title для выборки только нужных полей."""
+    return {f"{prefix}[{index}]": name for index, name in enumerate(fields)}
 
-    try:
-        params = {"filters[telegram_id][$eq]": telegram_id}
-        response = requests.get(
-            customers_url,
-            headers=headers,
-            params=params,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        customer_payload = response.json()
 
-        if customer_payload.get('data'):
-            return customer_payload['data'][0]
+def cart_items_params() -> dict:
+    return {
+        **select_fields("populate[items][fields]", CART_ITEM_FIELDS),
+        **select_fields("populate[items][populate][product][fields]", CART_PRODUCT_FIELDS)
+    }
 
-        return None
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при получении клиента: {e}")
+def get_media_attributes(media_field: Optional[dict]) -> Optional[dict]:
+    """Поля медиафайла: в Strapi 5 лежат на верхнем уровне, в Strapi 4 — в data.attributes."""
+    if not isinstance(media_field, dict):
         return None
+    if 'data' in media_field:
+        return (media_field.get('data') or {}).get('attributes')
+    return media_field
 
 
-def link_cart_to_customer_and_complete(
-        strapi_base_url: str,
-        strapi_token: str,
-        cart_document_id: str,
-        customer_document_id: str
-) -> Optional[dict]:
-    headers = {
-        "Authorization": f"Bearer {strapi_token}",
-        "Content-Type": "application/json"
-    }
-    cart_url = f"{strapi_base_url}/api/carts/{cart_document_id}"
+def get_media_url(url: str, strapi_base_url: str) -> str:
+    if url.startswith('/'):
+        return f"{strapi_base_url}{url}"
+    return url
 
-    try:
-        cart_payload = {
-            "data": {
-                "customer": customer_document_id,
-                "order_status": "completed"
-            }
-        }
-        response = requests.put(
-            cart_url,
-            headers=headers,
-            json=cart_payload,
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        logger.info(f"Заказ оформлен для корзины {cart_document_id}")
-        return response.json()['data']
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при обновлении корзины: {e}")
-        return None
@@ -0,0 +1,46 @@
+import json
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import InlineKeyboardMarkup
+from aiohttp import FormData
+from pydantic import PrivateAttr
+
+
+class PreparedKeyboard(InlineKeyboardMarkup):
+    """Клавиатура с заранее готовым JSON для Bot API.
+
+    aiogram сериализует разметку заново при каждой отправке. Клавиатуры
+    меню одинаковы для всех, поэтому JSON строится один раз при создании,
+    а PreparedMarkupSession подставляет его в запрос как есть.
+    """
+
+    _serialized: str = PrivateAttr(default="")
+
+    @classmethod
+    def from_markup(cls, markup: InlineKeyboardMarkup) -> 'PreparedKeyboard':
+        keyboard = cls(inline_keyboard=markup.inline_keyboard)
+        keyboard._serialized = json.dumps(
+            markup.model_dump(mode='json', exclude_none=True),
+            ensure_ascii=False,
+            separators=(',', ':')
+        )
+        return keyboard
+
+    @property
+    def serialized(self) -> str:
+        return self._serialized
+
+
+class PreparedMarkupSession(AiohttpSession):
+    """Сессия бота, которая не сериализует PreparedKeyboard повторно."""
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod) -> FormData:
+        markup = getattr(method, 'reply_markup', None)
+        if not isinstance(markup, PreparedKeyboard):
+            return super().build_form_data(bot, method)
+
+        form = super().build_form_data(bot, method.model_copy(update={'reply_markup': None}))
+        form.add_field('reply_markup', markup.serialized)
+        return form
@@ -0,0 +1,123 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+SLOW_UPDATE_THRESHOLD = 1.0
+PROFILE_DIR = "profiles"
+PROFILE_MAX_SECONDS = 300
+
+
+class UpdateTrace:
+    """Шаги обработки одного апдейта: запросы к Strapi, Bot API и ожидание в очереди."""
+
+    __slots__ = ('update_id', 'event_type', 'handler', 'started', 'spans')
+
+    def __init__(self, update_id: int, event_type: str):
+        self.update_id = update_id
+        self.event_type = event_type
+        self.handler: Optional[str] = None
+        self.started = time.perf_counter()
+        self.spans: list[tuple[str, float, float, Optional[str]]] = []
+
+    def duration(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        return {
+            "update_id": self.update_id,
+            "event_type": self.event_type,
+            "handler": self.handler,
+            "duration_ms": round(self.duration() * 1000, 1),
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round(start * 1000, 1),
+                    "duration_ms": round(duration * 1000, 1),
+                    **({"error": error} if error else {})
+                }
+                for name, start, duration, error in self.spans
+            ]
+        }
+
+
+current_trace: ContextVar[Optional[UpdateTrace]] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Записывает шаг в трассу текущего апдейта; вне апдейта ничего не делает."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        finished = time.perf_counter()
+        trace.spans.append((name, started - trace.started, finished - started, error))
+
+
+@contextmanager
+def trace_update(update_id: int, event_type: str, slow_threshold: float = SLOW_UPDATE_THRESHOLD):
+    """Трассирует апдейт и пишет его шаги в лог, если он обрабатывался дольше порога."""
+    trace = UpdateTrace(update_id, event_type)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        if slow_threshold and trace.duration() >= slow_threshold:
+            logger.warning(f"Медленный апдейт: {json.dumps(trace.as_dict(), ensure_ascii=False)}")
+
+
+class Profiler:
+    """Включает cProfile на время живой работы бота по запросу администратора.
+
+    Цикл событий работает в одном потоке, поэтому профиль захватывает
+    все обработчики, выполнившиеся за время замера. Одновременно идёт
+    не больше одного замера.
+    """
+
+    def __init__(self, profile_dir: str = PROFILE_DIR, max_seconds: float = PROFILE_MAX_SECONDS):
+        self.profile_dir = profile_dir
+        self.max_seconds = max_seconds
+        self._profile: Optional[cProfile.Profile] = None
+
+    @property
+    def running(self) -> bool:
+        return self._profile is not None
+
+    def start(self):
+        if self.running:
+            raise RuntimeError("Профилирование уже идёт")
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self, top: int = 30) -> tuple[str, str]:
+        """Сохраняет профиль в файл .pstats и возвращает путь и сводку по самым дорогим функциям."""
+        profile, self._profile = self._profile, None
+        profile.disable()
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.pstats")
+        profile.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(top)
+        logger.info(f"Профиль сохранён в {path}")
+        return path, summary.getvalue()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import signal
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from catalog import CatalogStore
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/webhook"
+WEBAPP_HOST = "0.0.0.0"
+WEBAPP_PORT = 8080
+WEBHOOK_SETUP_LOCK_KEY = "webhook:setup"
+WEBHOOK_SETUP_LOCK_TTL = 60
+# Сколько секунд после сигнала воркер отвечает 503 на /readyz, продолжая принимать апдейты,
+# чтобы балансировщик успел вывести его из ротации
+SHUTDOWN_GRACE = 10
+# Сколько ждать апдейты, уже подтверждённые Telegram, но ещё обрабатываемые в фоне
+DRAIN_TIMEOUT = 30
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler, который при остановке дожидается фоновой обработки апдейтов.
+
+    Telegram получает 200 сразу, а апдейт обрабатывается в фоновой задаче,
+    поэтому закрыть приложение, не дождавшись этих задач, значит потерять
+    уже подтверждённые апдейты.
+    """
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """Ждёт, пока фоновых задач не останется. False, если не дождались за timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Пока идёт ожидание, могут прийти и новые апдейты, поэтому проверяем набор заново
+        while self._background_feed_update_tasks:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            await asyncio.wait(set(self._background_feed_update_tasks), timeout=remaining)
+        return True
+
+
+def build_webhook_app(
+        dp: Dispatcher,
+        bot: Bot,
+        redis: Redis,
+        catalog: CatalogStore,
+        webhook_path: str = WEBHOOK_PATH,
+        webhook_secret: Optional[str] = None
+) -> web.Application:
+    """aiohttp-приложение воркера: приём апдейтов и проверки для балансировщика.
+
+    Воркер не хранит состояния между запросами: FSM лежит в общем Redis,
+    поэтому апдейты одного пользователя может обрабатывать любой воркер.
+    """
+    app = web.Application()
+    app['stopping'] = asyncio.Event()
+
+    request_handler = DrainingRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=webhook_secret
+    )
+    request_handler.register(app, path=webhook_path)
+    app['request_handler'] = request_handler
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def readyz(request: web.Request) -> web.Response:
+        if app['stopping'].is_set():
+            return web.json_response({"status": "stopping"}, status=503)
+        if not catalog.current.products:
+            return web.json_response({"status": "catalog not loaded"}, status=503)
+        try:
+            await redis.ping()
+        except RedisError as e:
+            return web.json_response({"status": f"redis unavailable: {e}"}, status=503)
+        return web.json_response({"status": "ready"})
+
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(
+        dp: Dispatcher,
+        bot: Bot,
+        redis: Redis,
+        catalog: CatalogStore,
+        webhook_url: str,
+        webhook_path: str = WEBHOOK_PATH,
+        webhook_secret: Optional[str] = None,
+        host: str = WEBAPP_HOST,
+        port: int = WEBAPP_PORT,
+        shutdown_grace: float = SHUTDOWN_GRACE,
+        drain_timeout: float = DRAIN_TIMEOUT
+):
+    """Запускает воркер и останавливает его без потери апдейтов.
+
+    По SIGTERM воркер сначала отвечает 503 на /readyz и ещё shutdown_grace
+    секунд принимает апдейты, пока балансировщик выводит его из ротации.
+    Затем дожидается апдейтов, обрабатываемых в фоне, и только после
+    этого закрывает сокет.
+    """
+    app = build_webhook_app(dp, bot, redis, catalog, webhook_path, webhook_secret)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port позволяет нескольким процессам-воркерам слушать один порт
+    site = web.TCPSite(runner, host, port, reuse_port=True)
+    await site.start()
+    logger.info(f"Воркер принимает вебхуки на {host}:{port}{webhook_path}")
+
+    # Вебхук регистрирует только один воркер из одновременно стартующих
+    if await redis.set(WEBHOOK_SETUP_LOCK_KEY, webhook_url, nx=True, ex=WEBHOOK_SETUP_LOCK_TTL):
+        await bot.set_webhook(
+            url=f"{webhook_url.rstrip('/')}{webhook_path}",
+            secret_token=webhook_secret,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info("Вебхук зарегистрирован в Telegram")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    try:
+        await stop_event.wait()
+        app['stopping'].set()
+        logger.info(f"Воркер выводится из ротации, ждём {shutdown_grace} с")
+        await asyncio.sleep(shutdown_grace)
+
+        request_handler = app['request_handler']
+        logger.info(f"Дожидаемся апдейтов в обработке: {request_handler.in_flight}")
+        if not await request_handler.drain(drain_timeout):
+            logger.warning(f"Не дождались апдейтов в обработке: {request_handler.in_flight}")
+    finally:
+        app['stopping'].set()
+        await runner.cleanup()